@@ -21,11 +21,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import argparse
 import codecs
+import collections
+import contextlib
+import errno
 import os
-import re
-import sys
+import threading
+import time
+import weakref
+
+from .metrics import Metrics
 
 try:
   unicode = unicode
@@ -61,65 +66,229 @@ _DEF_DEV = '/dev/ttyUSB0'
 _DEV_ENV = 'MSRX_DEV'
 _DELIM = '|'
 _DEF_TYPE = 'iso'
+_clock = getattr(time, 'monotonic', time.time)
+
+# The hardware sends raw track bytes with their bits reversed
+_BITREV = bytes(bytearray(
+  int('{0:08b}'.format(i)[::-1], 2) for i in range(256)
+))
 
 class ISO7811(object):
 
   _PARAM_MAP = {1: (0x20, 7), 2: (0x30, 5), 3: (0x30, 5)}
   _CODEC_NAMES = set(['iso7811-t%d' % i for i in _PARAM_MAP])
+  _START_SENTINELS = {1: '%', 2: ';', 3: ';'}
+  _END_SENTINEL = '?'
+  _TABLES = {}
+  _BIT_TABLES = {}
 
   @classmethod
   def codec_search(cls, name):
+    # Python 3.9+ normalizes '-' to '_' before calling search functions
+    name = name.replace('_', '-')
     if name in cls._CODEC_NAMES:
-      andlen = lambda x: (x, len(x))
       params = cls._PARAM_MAP[int(name[-1])]
-      return (
-        (lambda data: andlen(''.join(cls._enc(data, *params)))),
-        (lambda data: andlen(b''.join(cls._dec(data, *params)))),
-        None,
-        None
-      )
+
+      def encode(data, errors='strict'):
+        text, bad, lrc = cls._enc(data, *params)
+        if errors == 'strict' and (bad or lrc is False):
+          raise ParityError(text, bad, lrc)
+        return text, len(data)
+
+      def decode(data, errors='strict'):
+        return cls._dec(data, *params, strict=errors == 'strict'), len(data)
+
+      return (encode, decode, None, None)
     return None
-  
+
+  @classmethod
+  def unpack(cls, data, track):
+    '''unpack(data, track) -> (text, bad, lrc)
+
+    Unpack raw track data into ISO characters and check it.
+
+    bad: offsets of the characters with a bad parity bit
+    lrc: whether the character after the end sentinel matches the
+         computed LRC - None if there is no end sentinel or LRC
+    '''
+    return cls._enc(data, *cls._PARAM_MAP[track])
+
   @classmethod
-  def _dec(cls, data, low, bits):
-    atbit, whole = 0, 0
-    for d in data:
-      part = (ord(d) - low) & ((1 << (bits - 1)) - 1)
-      part |= (~(((part * 0x0101010101010101)
-              & 0x8040201008040201) % 0x1FF) & 1) << (bits - 1)
-      whole |= (part << atbit) & 255
-      atbit += bits
-      if atbit > 7:
-        yield to_byte(whole)
-        atbit = atbit % 8
-        whole = part >> (bits - atbit)
-    if atbit > 0:
-      yield to_byte(whole)
+  def pack(cls, text, track):
+    '''Pack ISO characters of a track into raw data, adding parity'''
+    return cls._dec(text, *cls._PARAM_MAP[track])
+
+  @classmethod
+  def search(cls, data, track):
+    '''search(data, track) -> (text, bad, lrc, offset, reverse)
+
+    Decode raw track data that doesn't start at bit 0 - a read with
+    leading clock bits or a card swiped backwards. The start sentinel is
+    looked for at every bit offset, in the bits as they are and in
+    reverse, and the decode that passes the most checks wins: a good
+    LRC with something between the sentinels, then an end sentinel,
+    then the fewest parity errors, then the longest text. Both
+    directions are always searched - stray bits often make a short
+    decode such as ';?4' that passes every check.
+
+    text, bad, lrc: as for unpack, from the start sentinel on
+    offset: bit offset of the start sentinel in the bits searched
+    reverse: whether the bits were searched in reverse
+
+    Returns None if there is no start sentinel.
+    '''
+    low, bits = cls._PARAM_MAP[track]
+    chars, good, codes = cls._tables(low, bits)
+    chunks = cls._bit_tables(bits)
+    data = bytes(bytearray(data))
+    if not data:
+      return None
+    start = '{0:0{1}b}'.format(codes[ord(cls._START_SENTINELS[track])],
+                               bits)[::-1]
+    # The end sentinel ends the text even with a bad parity bit
+    dmask = (1 << (bits - 1)) - 1
+    end = codes[ord(cls._END_SENTINEL)] & dmask
+    # Bits as '0'/'1' characters, bit 0 of the first byte first
+    whole = int(codecs.encode(data[::-1], 'hex_codec'), 16)
+    backward = '{0:0{1}b}'.format(whole, len(data) * 8)
+    best, best_score = None, None
+    for reverse, stream in ((False, backward[::-1]), (True, backward)):
+      offset = stream.find(start)
+      while offset >= 0:
+        found = bytearray()
+        pos, last = offset, len(stream) - bits
+        while pos <= last:
+          c = chunks[stream[pos:pos + bits]]
+          if not c:
+            break
+          found.append(c)
+          pos += bits
+          if len(found) > 1 and found[-2] & dmask == end:
+            break
+        text, bad, lrc = cls._check(bytes(found), chars, good, bits)
+        es = text.find(cls._END_SENTINEL)
+        score = (lrc is True and es > 1, es >= 0, -len(bad), len(text))
+        if best_score is None or score > best_score:
+          best, best_score = (text, bad, lrc, offset, reverse), score
+        offset = stream.find(start, offset + 1)
+    return best
+
+  @classmethod
+  def _bit_tables(cls, bits):
+    '''Dict from the bits of a raw code as '0'/'1' characters, lowest
+    bit first, to the code - built on first use'''
+    table = cls._BIT_TABLES.get(bits)
+    if table is None:
+      table = dict(
+        ('{0:0{1}b}'.format(c, bits)[::-1], c) for c in range(1 << bits)
+      )
+      cls._BIT_TABLES[bits] = table
+    return table
+
+  @classmethod
+  def _tables(cls, low, bits):
+    '''Lookup tables for a (low, bits) pair, built on first use
+
+    chars: 256 byte translate table from raw code to ASCII character
+    good: raw codes with a valid (odd) parity bit
+    codes: dict from character ordinal to raw code including parity
+    '''
+    tables = cls._TABLES.get((low, bits))
+    if tables is None:
+      dbits = bits - 1
+      chars = bytearray(256)
+      good = bytearray()
+      codes = {}
+      for c in range(1 << bits):
+        chars[c] = (c & ((1 << dbits) - 1)) + low
+        if bin(c).count('1') & 1:
+          good.append(c)
+          codes[chars[c]] = c
+      tables = bytes(chars), bytes(good), codes
+      cls._TABLES[low, bits] = tables
+    return tables
 
   @classmethod
   def _enc(cls, data, low, bits):
-    data = biter(iter(data))
-    try:
-      atbit, whole = 0, ord(next(data))
-      while True:
-        part = (whole >> atbit) & ((1 << bits) - 1)
-        atbit += bits
-        if atbit > 7:
-          whole = ord(next(data))
-          atbit = atbit % 8
-          part |= (whole & ((1 << atbit) - 1)) << (bits - atbit)
-        if part == 0:
-          return
-        # TODO verify the parity bit before yielding
-        yield to_uni((part & ((1 << (bits - 1)) - 1)) + low)
-    except StopIteration:
-      pass
+    chars, good, _ = cls._tables(low, bits)
+    data = bytes(bytearray(data))
+    mask = (1 << bits) - 1
+    whole = int(codecs.encode(data[::-1], 'hex_codec') or b'0', 16)
+    codes = bytes(bytearray(
+      (whole >> s) & mask for s in range(0, len(data) * 8 - bits + 1, bits)
+    ))
+    end = codes.find(b'\0')
+    if end >= 0:
+      codes = codes[:end]
+    return cls._check(codes, chars, good, bits)
+
+  @classmethod
+  def _check(cls, codes, chars, good, bits):
+    '''(text, bad, lrc) of raw codes, see unpack'''
+    mask = (1 << bits) - 1
+    text = codes.translate(chars).decode('ascii')
+
+    # Anything past the LRC is noise and isn't checked
+    lrc = None
+    es = text.find(cls._END_SENTINEL)
+    if 0 <= es < len(text) - 1:
+      codes = codes[:es + 2]
+      acc = 0
+      for c in bytearray(codes[:-1]):
+        acc ^= c
+      lrc = (acc ^ bytearray(codes)[-1]) & (mask >> 1) == 0
+
+    bad = []
+    if codes.translate(None, good):
+      bad = [i for i, c in enumerate(bytearray(codes)) if c not in good]
+    return text, bad, lrc
+
+  @classmethod
+  def _dec(cls, text, low, bits, strict=True):
+    _, _, codes = cls._tables(low, bits)
+    if not text:
+      return b''
+    hi = low + (1 << (bits - 1)) - 1
+    if min(text) < to_uni(low) or max(text) > to_uni(hi):
+      if strict:
+        raise ValueError(
+          'characters must be between %r and %r' % (to_uni(low), to_uni(hi))
+        )
+      text = ''.join(
+        to_uni(((ord(c) - low) & (hi - low)) + low) for c in text
+      )
+    whole = 0
+    for c in reversed(text):
+      whole = (whole << bits) | codes[ord(c)]
+    size = (len(text) * bits + 7) // 8
+    return codecs.decode('%0*x' % (size * 2, whole), 'hex_codec')[::-1]
 
 codecs.register(ISO7811.codec_search)
 
 class ProtocolError(Exception):
   pass
 
+class ParityError(ValueError):
+  '''Raised when raw track data fails the parity or LRC check
+
+  text: the decoded track data
+  offsets: offsets of the characters with a bad parity bit
+  lrc: False if the LRC didn't match, otherwise True or None
+  '''
+
+  def __init__(self, text, offsets, lrc):
+    problems = []
+    if offsets:
+      problems.append('bad parity at %s' % ', '.join(map(str, offsets)))
+    if lrc is False:
+      problems.append('LRC mismatch')
+    super(ParityError, self).__init__(
+      'track data %s' % ' and '.join(problems)
+    )
+    self.text = text
+    self.offsets = offsets
+    self.lrc = lrc
+
 class DeviceError(Exception):
 
   RW = 'read_write'
@@ -131,6 +300,470 @@ class DeviceError(Exception):
     super(DeviceError, self).__init__('MSR605 %s error' % code)
     self.code = code
 
+class Cancelled(Exception):
+  '''Raised when an operation is cancelled with MSRX.cancel()'''
+
+class Timeout(Cancelled):
+  '''Raised when an operation doesn't finish before its deadline'''
+
+class RetryPolicy(object):
+  '''Decides whether and when to retry an operation after a DeviceError
+
+  attempts: total number of attempts, including the first one
+  backoff: seconds to wait before the first retry
+  factor: multiplier applied to the wait after every retry
+  codes: DeviceError codes worth retrying
+  '''
+
+  def __init__(self, attempts=1, backoff=0.0, factor=2.0,
+               codes=(DeviceError.SWP, DeviceError.RW)):
+    self.attempts = attempts
+    self.backoff = backoff
+    self.factor = factor
+    self.codes = codes
+
+  def delay(self, error, attempt):
+    '''delay(error, attempt) -> seconds or None
+
+    How long to wait after failed attempt number `attempt` (counting
+    from 1) before trying again, or None to give up.
+    '''
+    if attempt >= self.attempts or error.code not in self.codes:
+      return None
+    return self.backoff * self.factor ** (attempt - 1)
+
+class ResponseParser(object):
+  '''Incremental parser for the responses of the MSR605
+
+  Feed it chunks of bytes as they arrive from the device, in any size,
+  and it returns the events parsed so far:
+
+    (START,)              start of track data
+    (TRACK, n, data)      data of track n, as sent by the device
+    (END,)                end of track data
+    (STATUS, code)        status byte - b'0' is success
+
+  Track data is length prefixed in responses to raw reads. Set iso for
+  responses to ISO reads, where it is ASCII up to the next track.
+  '''
+
+  START = 'start'
+  TRACK = 'track'
+  END = 'end'
+  STATUS = 'status'
+
+  def __init__(self):
+    self.iso = False
+    self.reset()
+
+  def reset(self):
+    '''Drop any buffered input and go back to the initial state'''
+    self._buf = bytearray()
+    self._pos = 0
+    self._in_tracks = False
+
+  def feed(self, data):
+    '''feed(data) -> [event, ...]'''
+    self._buf += data
+    events = []
+    while True:
+      event = self._next()
+      if event is None:
+        break
+      events.append(event)
+    if self._pos:
+      del self._buf[:self._pos]
+      self._pos = 0
+    return events
+
+  def _next(self):
+    buf, pos = self._buf, self._pos
+    avail = len(buf) - pos
+    if avail < 2:
+      return None
+    if self._in_tracks:
+      if buf[pos] == 0x1b and self.iso:
+        ends = [
+          e for e in (buf.find(b'\x1b', pos + 2), buf.find(b'?\x1c', pos + 2))
+          if e >= 0
+        ]
+        if not ends:
+          return None
+        self._pos = min(ends)
+        return (self.TRACK, buf[pos + 1], bytes(buf[pos + 2:self._pos]))
+      if buf[pos] == 0x1b:
+        if avail < 3 or avail < 3 + buf[pos + 2]:
+          return None
+        end = pos + 3 + buf[pos + 2]
+        self._pos = end
+        return (self.TRACK, buf[pos + 1], bytes(buf[pos + 3:end]))
+      if buf[pos:pos + 2] == b'?\x1c':
+        self._pos = pos + 2
+        self._in_tracks = False
+        return (self.END,)
+    elif buf[pos] == 0x1b:
+      self._pos = pos + 2
+      if buf[pos + 1] == ord('s'):
+        self._in_tracks = True
+        return (self.START,)
+      return (self.STATUS, bytes(buf[pos + 1:pos + 2]))
+    raise ProtocolError(
+      'unexpected data %s' % codecs.encode(
+        bytes(buf[pos:pos + 2]), 'hex_codec'
+      ).decode('ascii')
+    )
+
+# Card view not worked out yet - views can be None, e.g. a failed search
+_UNSET = object()
+
+class Card(object):
+  '''Tracks of a card as read raw by MSRX.read
+
+  Behaves as the sequence of the raw bytes of each track, as read()
+  used to return, but keeps them in one buffer: the length of each
+  track as a byte, then the tracks. The ISO-7811 and hex views of a
+  track are worked out the first time they are asked for and kept -
+  tracks are numbered from 1 there, as in ISO7811.unpack:
+
+    card = msr.read()
+    card.iso(2)       # ';4111111111111111=2512101?'
+    card.status(2)    # 'ok'
+  '''
+
+  # _views holds ISO7811.unpack of each track, then the hex and then
+  # ISO7811.search of each track, _UNSET until asked for - the list
+  # itself is None until a view is
+  __slots__ = ('_raw', '_views')
+
+  def __init__(self, tracks):
+    tracks = [bytes(d) for d in tracks]
+    if len(tracks) != _TRACK_CNT:
+      raise ValueError('a card has %d tracks' % _TRACK_CNT)
+    if any(len(d) > 255 for d in tracks):
+      raise ValueError('tracks are limited to 255 bytes')
+    self._raw = bytes(bytearray(len(d) for d in tracks)) + b''.join(tracks)
+    self._views = None
+
+  @classmethod
+  def _from_device(cls, tracks):
+    '''Card from tracks with their bits reversed as the hardware sends
+    them - reverses the whole buffer at once'''
+    card = cls(tracks)
+    card._raw = card._raw[:_TRACK_CNT] \
+      + card._raw[_TRACK_CNT:].translate(_BITREV)
+    return card
+
+  def _track(self, t):
+    sizes = bytearray(self._raw[:_TRACK_CNT])
+    start = _TRACK_CNT + sum(sizes[:t])
+    return self._raw[start:start + sizes[t]]
+
+  def _view(self, i, make):
+    if self._views is None:
+      self._views = [_UNSET] * (3 * _TRACK_CNT)
+    view = self._views[i]
+    if view is _UNSET:
+      view = self._views[i] = make()
+    return view
+
+  def __len__(self):
+    return _TRACK_CNT
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self._track(t) for t in range(_TRACK_CNT)[index]]
+    if index < 0:
+      index += _TRACK_CNT
+    if not 0 <= index < _TRACK_CNT:
+      raise IndexError('track index out of range')
+    return self._track(index)
+
+  def __iter__(self):
+    return (self._track(t) for t in range(_TRACK_CNT))
+
+  def __eq__(self, other):
+    if isinstance(other, (Card, list, tuple)):
+      return list(self) == list(other)
+    return NotImplemented
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    return equal if equal is NotImplemented else not equal
+
+  __hash__ = None
+
+  def __repr__(self):
+    return 'Card(%r)' % list(self)
+
+  def unpack(self, track):
+    '''ISO7811.unpack of a track: (text, bad, lrc)'''
+    return self._view(
+      track - 1, lambda: ISO7811.unpack(self._track(track - 1), track)
+    )
+
+  def decode(self, track, search=False):
+    '''(text, bad, lrc) of a track as for unpack - with search, from
+    search() unless that finds no start sentinel'''
+    found = self.search(track) if search else None
+    return found[:3] if found else self.unpack(track)
+
+  def iso(self, track, search=False):
+    '''ISO-7811 characters of a track, even if it fails the checks - see
+    decode for search'''
+    return self.decode(track, search)[0]
+
+  def status(self, track, search=False):
+    ''''empty', 'ok', or 'parity'/'lrc' when the track fails the
+    ISO-7811 checks - see decode for search'''
+    if not bytearray(self._raw[:_TRACK_CNT])[track - 1]:
+      return 'empty'
+    _, bad, lrc = self.decode(track, search)
+    return 'parity' if bad else 'lrc' if lrc is False else 'ok'
+
+  def hex(self, track):
+    '''Raw data of a track as hex digits'''
+    return self._view(_TRACK_CNT + track - 1, lambda: codecs.encode(
+      self._track(track - 1), 'hex_codec'
+    ).decode('ascii'))
+
+  def search(self, track):
+    '''ISO7811.search of a track: (text, bad, lrc, offset, reverse), None
+    if it has no start sentinel'''
+    return self._view(
+      2 * _TRACK_CNT + track - 1,
+      lambda: ISO7811.search(self._track(track - 1), track)
+    )
+
+_USB_IDS = ((0x0801, 0x0003),)
+
+# What a transport raises when its device is gone - pyserial lets
+# termios errors through from some calls
+try:
+  import termios
+  _DEV_LOST = (OSError, termios.error)
+except ImportError:
+  _DEV_LOST = (OSError,)
+
+def _open_device(device, timeout):
+  '''Open the transport for device - 'usb' for the first MSR605X,
+  'usb:BUS:ADDRESS' for a particular one, 'replay:PATH' or
+  'replay-fast:PATH' to play back a trace (see msrx.trace), otherwise
+  the path of a serial port. timeout is the read timeout in seconds.'''
+  if device.startswith(('replay:', 'replay-fast:')):
+    from .trace import Replay
+    mode, _, path = device.partition(':')
+    return Replay(path, realtime=mode == 'replay', timeout=timeout)
+  if device == 'usb' or device.startswith('usb:'):
+    from .msr605x import MSR605X
+    kwargs = {}
+    if device != 'usb':
+      bus, address = device[4:].split(':')
+      kwargs = {'bus': int(bus), 'address': int(address)}
+    dev = MSR605X(**kwargs)
+    dev.connect()
+    dev.timeout = timeout
+    return dev
+  import serial
+  return serial.Serial(
+    device, 9600, 8, serial.PARITY_NONE, timeout=timeout, exclusive=True
+  )
+
+def _probe(port, timeout):
+  '''Check whether an MSR605 answers the communication test on port -
+  None if the port couldn't be opened, e.g. because it is in use'''
+  try:
+    dev = _open_device(port, timeout)
+  except (OSError, ValueError):
+    return None
+  try:
+    dev.write(b'\x1be')
+    return dev.read(2) == b'\x1by'
+  except OSError:
+    return False
+  finally:
+    dev.close()
+
+def _location(device, usb_dev=None):
+  '''Physical location of a reader - the USB bus and port path - that
+  stays the same when it is replugged, None if unknown
+
+  usb_dev: the usb.core.Device of an MSR605X
+  '''
+  if usb_dev is not None:
+    ports = getattr(usb_dev, 'port_numbers', None)
+    if not ports:
+      return None
+    return 'usb-%d-%s' % (usb_dev.bus, '.'.join(str(p) for p in ports))
+  try:
+    from serial.tools import list_ports
+  except ImportError:
+    return None
+  for port in list_ports.comports():
+    if port.device == device:
+      return port.location
+  return None
+
+def _locate(location):
+  '''Names of the readers currently at location'''
+  found = []
+  try:
+    from serial.tools import list_ports
+    found.extend(
+      p.device for p in list_ports.comports() if p.location == location
+    )
+  except ImportError:
+    pass
+  try:
+    import usb.core as usb_core
+    for vid, pid in _USB_IDS:
+      for d in usb_core.find(find_all=True, idVendor=vid, idProduct=pid):
+        if _location(None, d) == location:
+          found.append('usb:%d:%d' % (d.bus, d.address))
+  except ImportError:
+    pass
+  except usb_core.NoBackendError:
+    pass
+  return found
+
+_CACHE_ENV = 'MSRX_CACHE'
+
+def _cache_path():
+  '''Where discover() remembers the ports it probed - MSRX_CACHE, else
+  msrx/devices in XDG_CACHE_HOME or ~/.cache'''
+  if os.environ.get(_CACHE_ENV):
+    return os.environ[_CACHE_ENV]
+  base = os.environ.get('XDG_CACHE_HOME') \
+    or os.path.join(os.path.expanduser('~'), '.cache')
+  return os.path.join(base, __progname__, 'devices')
+
+def _load_cache():
+  '''Serial ports probed before: {(device, hwid): whether a reader
+  answered}. A line of the cache is '+' or '-', the device and its
+  hardware id, separated by tabs.'''
+  probed = {}
+  try:
+    with open(_cache_path()) as f:
+      for line in f:
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) == 3 and fields[0] in ('+', '-'):
+          probed[fields[1], fields[2]] = fields[0] == '+'
+  except (IOError, OSError):
+    pass
+  return probed
+
+def _save_cache(probed):
+  '''Replace the cache atomically - a cache that can't be written is
+  only a slower next discover()'''
+  path = _cache_path()
+  tmp = '%s.%d.tmp' % (path, os.getpid())
+  try:
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(tmp, 'w') as f:
+      f.write(''.join(
+        '%s\t%s\t%s\n' % ('+' if ok else '-', device, hwid)
+        for (device, hwid), ok in sorted(probed.items())
+      ))
+    os.rename(tmp, path)
+  except (IOError, OSError):
+    pass
+
+def discover(serial=True, usb=True, timeout=0.5, cache=True):
+  '''discover() -> [device, ...]
+
+  Find attached readers. Serial ports are probed with the communication
+  test command, so ports open elsewhere are skipped. USB readers are
+  named 'usb:BUS:ADDRESS'. Every name can be passed to MSRX.
+
+  Probing a port that isn't a reader takes the whole timeout, so with
+  cache the outcome of every probe is remembered along with the port's
+  hardware id. Ports that weren't readers are skipped until their
+  hardware id changes; readers are probed again, which is quick, and so
+  is every port not seen before. Ports that couldn't be opened aren't
+  remembered. cache=False always probes every port.
+  '''
+  found = []
+  probed = {}
+  if serial:
+    try:
+      from serial.tools import list_ports
+    except ImportError:
+      ports = []
+    else:
+      ports = sorted((p.device, p.hwid or '') for p in list_ports.comports())
+    known = _load_cache() if cache else {}
+    for port in ports:
+      ok = False if known.get(port) is False else _probe(port[0], timeout)
+      if ok is not None:
+        probed[port] = ok
+      if ok:
+        found.append(port[0])
+  if usb:
+    try:
+      import usb.core as usb_core
+      for vid, pid in _USB_IDS:
+        found.extend(
+          'usb:%d:%d' % (d.bus, d.address) for d in usb_core.find(
+            find_all=True, idVendor=vid, idProduct=pid
+          )
+        )
+    except ImportError:
+      pass
+    except usb_core.NoBackendError:
+      pass
+  if cache and serial:
+    _save_cache(probed)
+  return found
+
+# Outcome of MSRX.write_verified
+VerifyResult = collections.namedtuple(
+  'VerifyResult', 'ok attempts tracks read'
+)
+
+def _verify_key(data, track, iso):
+  '''What has to match between a written and a read back track: the
+  characters up to the end sentinel (and the LRC for raw data, along
+  with the parity and LRC checks) - anything after is noise'''
+  if iso:
+    es = data.find(ISO7811._END_SENTINEL)
+    return data[:es + 1] if es >= 0 else data
+  text, bad, lrc = ISO7811.unpack(data, track)
+  es = text.find(ISO7811._END_SENTINEL)
+  return (text[:es + 2] if es >= 0 else text), bad, lrc
+
+def _write_verified(msrx, tracks, timeout, mode, attempts):
+  '''MSRX.write_verified for anything with MSRX's write and read'''
+  if attempts < 1:
+    raise ValueError('attempts must be at least 1')
+  iso = MSRX._mode(mode)
+  empty = '' if iso else b''
+  pending = [bool(d) for d in tracks]
+  read = [empty] * _TRACK_CNT
+  for attempt in range(1, attempts + 1):
+    try:
+      msrx.write(
+        [d if p else empty for d, p in zip(tracks, pending)],
+        timeout=timeout, mode=mode
+      )
+    except DeviceError:
+      continue
+    try:
+      read = msrx.read(timeout=timeout, mode=mode)
+    except DeviceError as e:
+      read = getattr(e, 'tracks', read)
+    pending = [
+      p and _verify_key(d, t + 1, iso) != _verify_key(r, t + 1, iso)
+      for d, r, p, t in zip(tracks, read, pending, range(_TRACK_CNT))
+    ]
+    if not any(pending):
+      break
+  return VerifyResult(
+    not any(pending), attempt,
+    ['skipped' if not d else 'mismatch' if p else 'ok'
+     for d, p in zip(tracks, pending)],
+    read
+  )
+
 class MSRX(object):
 
   _DEV_ERR = {
@@ -141,85 +774,478 @@ class MSRX(object):
     b'A': DeviceError.ERASE
   }
 
-  def __init__(self, device):
-    '''Open the serial device'''
-    if device == "usb":
-      from .msr605x import MSR605X
-      self._dev = MSR605X()
-      self._dev.connect()
-    else:
-      import serial
-      self._dev = serial.Serial(device, 9600, 8, serial.PARITY_NONE)
+  # How often blocked reads wake up to check deadlines and cancellation
+  _POLL = 0.1
+
+  # Read/write modes: raw bits, where the host does any decoding, or
+  # ISO-7811 text, decoded and encoded by the device itself
+  _MODES = ('raw', 'iso')
+
+  # Response phase that starts with each event, see msrx.metrics
+  _NEXT_PHASE = {
+    ResponseParser.START: 'transfer',
+    ResponseParser.END: 'status'
+  }
+
+  # Open instances by device name, so reconnecting never takes over a
+  # reader another instance is using
+  _OPEN = weakref.WeakValueDictionary()
+  _OPEN_LOCK = threading.Lock()
+
+  def __init__(self, device, retry=None, metrics=None, trace=None,
+               reconnect=None):
+    '''Open the serial device
+
+    retry: RetryPolicy for read, write and erase - defaults to no retries
+    metrics: msrx.metrics.Metrics to record into - defaults to a new one
+    trace: path to record all traffic with the device to - see
+           msrx.trace
+    reconnect: seconds to keep trying to get the device back when it is
+               lost, e.g. unplugged - None to give up right away. Set
+               after opening, the device is only looked for under its
+               old name.
+    '''
+    self.device = device
+    self.retry = retry or RetryPolicy()
+    self.metrics = metrics or Metrics()
+    self.reconnect = reconnect
+    # Called after a reconnect with the lost device, the device now in use
+    # (which differs when the reader came back under another name) and
+    # the seconds it took
+    self.on_reconnect = None
+    self._recorder = None
+    self._dev = None
+    self._location = None
+    self._attach(_open_device(device, self._POLL))
+    if trace is not None:
+      from .trace import Recorder
+      self._dev = self._recorder = Recorder(self._dev, trace)
+    # Start of the response phase being timed and its name
+    self._mark = None
+    self._phase = None
+    self._parser = ResponseParser()
+    self._events = collections.deque()
+    self._cancel = threading.Event()
+    self._deadline = None
+    # Device modes as far as we know - None when unknown
+    self._coercivity = None
+    self._pristine = False
+    self._sessions = 0
+
+  def _attach(self, dev):
+    '''Start using the freshly opened transport dev'''
+    usb_dev = getattr(dev, 'dev', None)
+    if self.device == 'usb' and usb_dev is not None:
+      # Pin the first MSR605X down, so reconnecting can't pick up another
+      # one that happens to be found first
+      self.device = 'usb:%d:%d' % (usb_dev.bus, usb_dev.address)
+    # Looking up the location is slow (it lists every serial port) and
+    # only needed to reconnect - it can't wait until then, since a lost
+    # device no longer has one
+    self._location = None
+    if self.reconnect is not None:
+      self._location = _location(self.device, usb_dev)
+    if hasattr(dev, 'metrics'):
+      dev.metrics = self.metrics
+    if self._recorder is not None:
+      self._recorder._dev = dev
+      dev = self._recorder
+    self._dev = dev
+    with self._OPEN_LOCK:
+      self._OPEN[self.device] = self
+
+  def _detach(self):
+    '''Stop using and close the transport'''
+    dev, self._dev = self._dev, None
+    with self._OPEN_LOCK:
+      if self._OPEN.get(self.device) is self:
+        del self._OPEN[self.device]
+    if self._recorder is not None:
+      dev = self._recorder._dev
+    try:
+      if hasattr(dev, 'close'):
+        dev.close()
+    except (OSError, ValueError):
+      pass
+
+  def close(self):
+    '''Close the device'''
+    if self._dev is not None:
+      self._detach()
+    if self._recorder is not None:
+      self._recorder._file.close()
+
+  def _reopen(self):
+    '''Open the lost device again, under a new name if it came back as
+    another device at the same physical location (e.g. at another USB
+    address). Returns whether a device was opened.'''
+    with self._OPEN_LOCK:
+      in_use = set(self._OPEN)
+    candidates = [self.device] if self.device not in in_use else []
+    if self._location is not None:
+      candidates += [
+        d for d in _locate(self._location)
+        if d != self.device and d not in in_use
+      ]
+    for device in candidates:
+      try:
+        dev = _open_device(device, self._POLL)
+      except (OSError, ValueError):
+        continue
+      self.device = device
+      self._attach(dev)
+      return True
+    return False
+
+  def _reconnect(self, error):
+    '''Wait for the lost device to come back, then put it back in the
+    mode it was in. Raises error if it doesn't come back in time.'''
+    if not isinstance(error, OSError):
+      error = OSError(*error.args)
+    if self.reconnect is None:
+      raise error
+    lost = self.device
+    start = _clock()
+    if self._dev is not None:
+      self._detach()
+    while not self._reopen():
+      if _clock() - start >= self.reconnect:
+        raise error
+      self._check_deadline()
+      self._cancel.wait(self._POLL)
+    # A fresh device is in low coercivity, a glitch may have left it in
+    # any mode
+    self._dev.write(b'\x1ba')
+    if self._coercivity == 'hi':
+      self._dev.write(b'\x1bx')
+    self._dev.flush()
+    self._pristine = self._coercivity is None
+    self._parser.reset()
+    self._events.clear()
+    self._phase = None
+    elapsed = _clock() - start
+    self.metrics.observe('reconnect', elapsed)
+    if self.on_reconnect is not None:
+      self.on_reconnect(lost, self.device, elapsed)
+
+  def _ensure_open(self):
+    if self._dev is None:
+      self._reconnect(OSError(errno.ENODEV, 'device %s is gone' % self.device))
 
   def _send(self, d):
+    self._pristine = False
+    self._ensure_open()
+    start = _clock()
     self._dev.write(d)
     self._dev.flush()
+    self.metrics.observe('send', _clock() - start)
+
+  def _control(self, d):
+    '''Send a command that has no response outside of _run, getting the
+    device back first if it was lost'''
+    try:
+      self._send(d)
+    except _DEV_LOST as e:
+      self._reconnect(e)
+      self._send(d)
+
+  def _command(self, d, iso=False):
+    '''Send a command, dropping anything left over from earlier ones
+
+    iso: the response carries ISO rather than raw track data
+    '''
+    self._parser.reset()
+    self._parser.iso = iso
+    self._events.clear()
+    self._send(d)
+    self._mark, self._phase = _clock(), 'swipe'
+
+  def _next_event(self):
+    '''Return the next parsed response event, reading as needed
+
+    Reads everything the device has buffered at once rather than a byte
+    at a time.
+    '''
+    while not self._events:
+      self._check_deadline()
+      chunk = self._dev.read(self._dev.in_waiting or 1)
+      if chunk:
+        self._events.extend(self._parser.feed(chunk))
+    return self._events.popleft()
+
+  def _check_deadline(self):
+    if self._cancel.is_set():
+      raise Cancelled('operation cancelled')
+    if self._deadline is not None and _clock() >= self._deadline:
+      raise Timeout('operation timed out')
 
-  def _expect(self, d):
-    rd = self._dev.read(len(d))
-    if rd != d:
-      raise ProtocolError('expected %s, got %s' % (
-        codecs.encode(rd, 'hex_codec'), codecs.encode(d, 'hex_encode')
+  def _resync(self):
+    '''Abort the command in progress and drop any pending response'''
+    if self._dev is None:
+      return
+    try:
+      self._send(b'\x1ba')
+      self._pristine, self._coercivity = True, None
+      time.sleep(self._POLL)
+      self._dev.reset_input_buffer()
+    except _DEV_LOST:
+      # Leave getting it back to the next operation
+      self._detach()
+    self._parser.reset()
+    self._events.clear()
+    self._phase = None
+
+  def _run(self, func, timeout, fresh=True):
+    '''Run an operation under a deadline and the retry policy
+
+    Timeouts, cancellation, protocol errors and interrupts leave the
+    device in an unknown state, so it is reset before the error is
+    passed on. fresh=False keeps a cancel() from before the call.
+
+    When the device is lost and reconnect is set, the operation starts
+    over once the device is back.
+    '''
+    if fresh:
+      self._cancel.clear()
+    self._deadline = None if timeout is None else _clock() + timeout
+    attempt = 0
+    try:
+      while True:
+        attempt += 1
+        self._ensure_open()
+        try:
+          return func()
+        except DeviceError as e:
+          self.metrics.device_error(e.code)
+          delay = self.retry.delay(e, attempt)
+          if delay is None:
+            raise
+        except _DEV_LOST as e:
+          self._reconnect(e)
+          attempt -= 1
+          continue
+        if self._deadline is not None:
+          delay = min(delay, max(0, self._deadline - _clock()))
+        if self._cancel.wait(delay):
+          raise Cancelled('operation cancelled')
+        self._check_deadline()
+    except (Cancelled, ProtocolError, KeyboardInterrupt) as e:
+      if isinstance(e, Timeout):
+        self.metrics.timeout()
+      elif isinstance(e, ProtocolError):
+        self.metrics.protocol_error()
+      self._resync()
+      raise
+    finally:
+      self._deadline = None
+
+  def cancel(self):
+    '''Cancel the read, write or erase in progress - safe to call from
+    another thread. The cancelled call raises Cancelled.'''
+    self._cancel.set()
+
+  def _expect(self, kind, track=None):
+    event = self._check_event(self._next_event(), kind, track)
+    if kind != ResponseParser.TRACK and self._phase is not None:
+      # The status ends whichever phase is in progress
+      now = _clock()
+      self.metrics.observe(self._phase, now - self._mark)
+      self._mark, self._phase = now, self._NEXT_PHASE.get(kind)
+    return event
+
+  @classmethod
+  def _check_event(cls, event, kind, track=None):
+    '''Make sure event is of the given kind (and track) and return it'''
+    if event[0] != kind or (track is not None and event[1] != track):
+      if event[0] == ResponseParser.STATUS:
+        cls._check_status(event[1])
+      raise ProtocolError('expected %s%s, got %s' % (
+        kind, '' if track is None else ' %d' % track,
+        ' '.join(str(e) for e in event[:2])
       ))
+    return event
 
   def reset(self):
-    '''Reset device to initial state'''
-    self._send(b'\x1ba')
+    '''Reset device to initial state
+
+    Skipped when nothing was sent to the device since the last reset.
+    '''
+    if self._pristine:
+      return
+    self._control(b'\x1ba')
+    self._pristine, self._coercivity = True, None
 
   def hico(self):
-    '''set high coercion'''
-    self._send(b'\x1bx')
+    '''set high coercion - skipped if the device is already in it'''
+    if self._coercivity != 'hi':
+      self._control(b'\x1bx')
+      self._coercivity = 'hi'
 
   def loco(self):
-    '''set low coercion'''
-    self._send(b'\x1by')
+    '''set low coercion - skipped if the device is already in it'''
+    if self._coercivity != 'lo':
+      self._control(b'\x1by')
+      self._coercivity = 'lo'
 
-  def erase(self, tracks=(True, True, True)):
+  @contextlib.contextmanager
+  def session(self, hico=None, reset=True):
+    '''Run several operations under a single setup and teardown
+
+      with msrx.session(hico=True):
+        for tracks in cards:
+          msrx.write(tracks)
+
+    The outermost session resets the device first unless reset is
+    False. hico selects high (True) or low (False) coercivity for the
+    session, None leaves it as it is. On the way out the coercivity
+    goes back to what it was before the session, or to low coercivity
+    if that isn't known.
+    '''
+    before = self._coercivity
+    if reset and not self._sessions:
+      self.reset()
+    if hico is not None:
+      self.hico() if hico else self.loco()
+    self._sessions += 1
+    try:
+      yield self
+    finally:
+      self._sessions -= 1
+      if hico is not None:
+        self.hico() if before == 'hi' else self.loco()
+
+  def erase(self, tracks=(True, True, True), timeout=None):
     '''Erase tracks
 
     tracks: tuple of 3 bools - each indicating whether the corresponding
             track should be erased.
+    timeout: seconds to wait for the swipe - raises Timeout when over
     '''
-    self._send(b'\x1bc' + to_byte(
+    self._run(lambda: self._erase(tracks), timeout)
+
+  def _erase(self, tracks):
+    self._command(self._erase_cmd(tracks))
+    self._handle_status()
+
+  @staticmethod
+  def _erase_cmd(tracks):
+    return b'\x1bc' + to_byte(
       (1 if tracks[0] else 0)
       | (2 if tracks[1] else 0)
       | (4 if tracks[2] else 0)
-    ))
-    self._handle_status()
+    )
 
-  def read(self):
+  def read(self, timeout=None, mode='raw'):
     '''read() -> (t1, t2, t3)
 
     Read all tracks
+
+    timeout: seconds to wait for the swipe - raises Timeout when over
+    mode: 'raw' for the raw bits of each track as a Card, a sequence of
+          byte strings, 'iso' to have the device decode ISO-7811 tracks
+          and return them as strings - see _MODES
     '''
-    tracks = [b''] * _TRACK_CNT
-    self._send(b'\x1bm')
-    self._expect(b'\x1bs')
+    return self._run(lambda: self._read(mode), timeout)
+
+  def _read(self, mode='raw'):
+    iso = self._mode(mode)
+    tracks = [''] * _TRACK_CNT if iso else [b''] * _TRACK_CNT
+    self._command(b'\x1br' if iso else b'\x1bm', iso=iso)
+    self._expect(ResponseParser.START)
     for t in range(_TRACK_CNT):
-      self._expect(b'\x1b' + to_byte(t + 1))
-      tracks[t] = b''.join(
-        # Some bit hackery to reverse the bits - we shouldn't need this
-        # but the hardware works in mysterious ways.
-        to_byte((((ord(c) * 0x80200802)
-                & 0x0884422110) * 0x0101010101 >> 32) & 255)
-        for c in biter(self._dev.read(ord(self._dev.read(1))))
-      )
-    self._expect(b'?\x1c')
-    self._handle_status()
+      data = self._expect(ResponseParser.TRACK, t + 1)[2]
+      tracks[t] = data.decode('ascii') if iso else data
+    if not iso:
+      # We shouldn't need to reverse the bits but the hardware works in
+      # mysterious ways.
+      tracks = Card._from_device(tracks)
+    self._expect(ResponseParser.END)
+    try:
+      self._handle_status()
+    except DeviceError as e:
+      e.tracks = tracks
+      raise
     return tracks
 
-  def write(self, tracks):
+  def read_continuous(self, timeout=None):
+    '''read_continuous() -> iterator of (time, tracks, error)
+
+    Read cards back to back without closing or resetting the device,
+    yielding one record per swipe: the time.time() of the swipe, the
+    tracks as returned by read() and the DeviceError, if any, raised for
+    the swipe (with the tracks the device sent anyway).
+
+    Iteration stops when cancel() is called or when no card is swiped
+    within timeout seconds.
+    '''
+    self._cancel.clear()
+    while True:
+      try:
+        tracks = self._run(self._read, timeout, fresh=False)
+        error = None
+      except DeviceError as e:
+        tracks = getattr(e, 'tracks', Card([b''] * _TRACK_CNT))
+        error = e
+      except Cancelled:
+        return
+      yield time.time(), tracks, error
+
+  def write(self, tracks, timeout=None, mode='raw'):
     '''Write all tracks
 
     tracks: tuple of three byte strings, each data for the corresponding
             track. To preserve a track, pass empty byte string.
+    timeout: seconds to wait for the swipe - raises Timeout when over
+    mode: 'raw' to write tracks as is, 'iso' to pass ISO-7811 strings
+          for the device to encode - see _MODES
     '''
-    self._send(b'\x1bn\x1bs')
-    for t, i in zip(tracks, range(_TRACK_CNT)):
-      self._send(b'\x1b' + to_byte(i + 1) + to_byte(len(t)) + t)
-    self._send(b'?\x1c')
+    self._run(lambda: self._write(tracks, mode), timeout)
+
+  def write_verified(self, tracks, timeout=None, mode='raw', attempts=3):
+    '''write_verified(tracks) -> VerifyResult
+
+    Write all tracks, read the card back and compare it track by track,
+    then write only the tracks that didn't match again - each attempt
+    takes a swipe to write and one to read back. A write that fails
+    with a DeviceError uses up an attempt.
+
+    tracks, timeout, mode: as for write() - empty tracks are left as
+                           they are and not checked
+    attempts: the most writes to make
+
+    Returns VerifyResult(ok, attempts, tracks, read): whether every
+    track matched, the writes made, 'ok', 'mismatch' or 'skipped' for
+    each track and the tracks last read back.
+    '''
+    return _write_verified(self, tracks, timeout, mode, attempts)
+
+  def _write(self, tracks, mode='raw'):
+    self._command(self._write_cmd(tracks, self._mode(mode)))
     self._handle_status()
 
+  @staticmethod
+  def _write_cmd(tracks, iso=False):
+    if iso:
+      return b''.join(
+        [b'\x1bw\x1bs']
+        + [b'\x1b' + to_byte(i + 1) + t.encode('ascii')
+           for t, i in zip(tracks, range(_TRACK_CNT))]
+        + [b'?\x1c']
+      )
+    return b''.join(
+      [b'\x1bn\x1bs']
+      + [b'\x1b' + to_byte(i + 1) + to_byte(len(t)) + t
+         for t, i in zip(tracks, range(_TRACK_CNT))]
+      + [b'?\x1c']
+    )
+
+  @classmethod
+  def _mode(cls, mode):
+    '''Whether mode is the ISO one, rejecting unknown modes'''
+    if mode not in cls._MODES:
+      raise ValueError('mode must be one of %s' % ', '.join(cls._MODES))
+    return mode == 'iso'
+
   def raw(self, data):
     msg = b'\x1b' + data.encode('UTF-8')
     print(msg)
@@ -228,212 +1254,21 @@ class MSRX(object):
     print(result)
 
   def _handle_status(self):
-    self._expect(b'\x1b')
-    status = self._dev.read(1)
+    self._check_status(self._expect(ResponseParser.STATUS)[1])
+
+  @classmethod
+  def _check_status(cls, status):
     if status == b'0':
       return
-    elif status in self._DEV_ERR:
-      raise DeviceError(self._DEV_ERR[status])
+    elif status in cls._DEV_ERR:
+      raise DeviceError(cls._DEV_ERR[status])
     else:
       raise ProtocolError(
-        "invalid status %s" % codec.encode(status, 'hex_codec')
+        'invalid status %s'
+        % codecs.encode(status, 'hex_codec').decode('ascii')
       )
 
-_DATA_CONV = {
-  ('raw', 'hex'):
-    (lambda d, _: codecs.encode(d, 'hex_codec')),
-  ('hex', 'raw'): (lambda d, _: codecs.decode(d, 'hex_codec')),
-  ('raw', 'iso'):
-    (lambda d, t: codecs.encode(d, 'iso7811-t%d' % t)),
-  ('iso', 'raw'): (lambda d, t: codecs.decode(d, 'iso7811-t%d' % t))
-}
-
-_DTYPE_VFY = {
-  'hex': lambda d, _: bool(re.search(r'^[0-9a-fA-F]*$', d)),
-  'iso': lambda d, t: bool(
-    re.search(r'^[ -_]*$' if t == 1 else r'^[0-?]*$', d)
-  )
-}
-
-def _do_read(args):
-
-  print(_DELIM.join(
-    _DATA_CONV[('raw', args.type)](d, t + 1)
-    for d, t in zip(args.msrx.read(), range(_TRACK_CNT))
-  ))
-
-def _do_write(args):
-
-  data = (args.data or input()).split(_DELIM)
-  if len(data) != _TRACK_CNT:
-    args.parser.error(
-      "there must be exactly be %d '%s'"
-      " in data separating the %d tracks"
-      % (_TRACK_CNT - 1, _DELIM, _TRACK_CNT)
-    )
-  if not all(
-    _DTYPE_VFY[args.type](d, t + 1)
-    for d, t in zip(data, range(_TRACK_CNT))
-  ):
-    args.parser.error(
-      "the data doesn't match the type given (%s)" % args.type
-    )
-
-  data = [
-    _DATA_CONV[args.type, 'raw'](d, t + 1)
-    for d, t in zip(data, range(_TRACK_CNT))
-  ]
-  args.msrx.write(data)
-
-def _do_erase(args):
-
-  args.msrx.erase(args.tracks)
-
-def _do_raw(args):
-  args.msrx.raw(args.data)
-
 def main():
-
-  def track_sel_type(data):
-    tracks = [False] * _TRACK_CNT
-    try:
-      for t in map(int, data.split(',')):
-        if t > _TRACK_CNT or t < 1:
-          raise argparse.ArgumentTypeError(
-            'track numbers must be between %d and %d'
-            % (1, _TRACK_CNT)
-          )
-        tracks[t - 1] = True
-    except ValueError:
-      raise argparse.ArgumentTypeError(
-        'provide track numbers separated with commas - e.g 1,3'
-      )
-    return tracks
-
-  def add_type_arg(parser):
-    parser.add_argument(
-      '-t', '--type',
-      metavar='TYPE',
-      default=_DEF_TYPE,
-      choices=list(_DTYPE_VFY),
-      type=unicode,
-      help='data type: %s - defaults to %s'
-           % (', '.join(_DTYPE_VFY), _DEF_TYPE)
-    )
-
-  if any(a == '--version' for a in sys.argv[1:]):
-    print(__verinfo__)
-    exit(0)
-
-  parser = argparse.ArgumentParser(
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-    description=__description__
-  )
-  parser.add_argument(
-    '-D', '--dev',
-    metavar='DEV',
-    default=os.environ.get(_DEV_ENV, _DEF_DEV),
-    help='serial device to use - can be override by %s env'
-         ' variable - defaults to %s' % (_DEV_ENV, _DEF_DEV)
-  )
-  parser.add_argument(
-    '-R', '--no-reset',
-    action='store_true',
-    default=False,
-    help='do NOT issue reset before the main command'
-  )
-  parser.add_argument(
-    '-H', '--hico',
-    action='store_true',
-    default=False,
-    help='Set Hi-Coercitivity mode'
-  )
-  parser.add_argument(
-    '--version',
-    action='store_true',
-    help='show license and version of ' + __progname__
-  )
-
-  subparsers = parser.add_subparsers(
-    dest='cmd'
-  )
-
-  parser_a = subparsers.add_parser(
-    'read',
-    description='Read card and output data as'
-                " '%s' delimited string to stdout" % _DELIM,
-    help='read card'
-  )
-  add_type_arg(parser_a)
-  parser_a.set_defaults(func=_do_read)
-
-  parser_a = subparsers.add_parser(
-    'write',
-    description="Write to card from '%s' delimited data in stdin"
-                " or from --data command line arg" % _DELIM,
-    help='write card'
-  )
-  parser_a.add_argument(
-    '-d', '--data',
-    metavar='DATA',
-    default=None,
-    type=unicode,
-    help='data to write - overrides stdin'
-  )
-  add_type_arg(parser_a)
-  parser_a.set_defaults(func=_do_write)
-
-  parser_a = subparsers.add_parser(
-    'erase',
-    description='Erase all tracks',
-    help='erase card'
-  )
-  parser_a.add_argument(
-    '-t', '--tracks',
-    metavar='TRACKS',
-    default=','.join(str(i + 1) for i in range(_TRACK_CNT)),
-    type=track_sel_type,
-    help='tracks to erase - default is '
-         + ','.join(str(i + 1) for i in range(_TRACK_CNT))
-  )
-  parser_a.set_defaults(func=_do_erase)
-
-  parser_a = subparsers.add_parser(
-    'raw',
-    description='Raw command',
-    help='Perform raw command'
-  )
-  parser_a.add_argument(
-    '-d', '--data',
-    metavar='DATA',
-    type=unicode,
-    help='data to write - overrides stdin'
-  )
-  parser_a.set_defaults(func=_do_raw)
-
-  args = parser.parse_args()
-  args.parser = parser
-
-  try:
-    msrxinst = MSRX(args.dev)
-    if not args.no_reset:
-      msrxinst.reset()
-    if args.hico:
-      msrxinst.hico()
-
-    args.msrx = msrxinst
-    args.func(args)
-
-    if args.hico: # Return to low-coercion
-      msrxinst.loco()
-  except OSError as e:
-    print(
-      '%s: error: %s' % (__progname__, os.strerror(e.errno)),
-      file=sys.stderr
-    )
-  except (DeviceError, ProtocolError) as e:
-    print('%s: error: %s' % (__progname__, e.args[0]), file=sys.stderr)
-    exit(254)
-  except KeyboardInterrupt:
-    print('keyboard interrupt', file=sys.stderr)
-    exit(255)
+  '''Run the command line interface - see msrx.cli'''
+  from .cli import main
+  main()
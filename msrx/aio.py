@@ -0,0 +1,252 @@
+# aio.py - asyncio driver for the MSR605 magnetic card reader/writer
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""asyncio driver for the MSR605 magnetic card reader/writer (python 3)
+
+    async with AsyncMSRX('/dev/ttyUSB0') as msr:
+      tracks = await msr.read(timeout=30)
+
+Serial ports are read from the event loop as data arrives. The MSR605X
+has no file descriptor to wait on, so a dedicated thread receives its
+messages and hands them to the loop. Writes go through a single worker
+thread so a slow transfer never blocks the loop.
+
+When receiving fails, e.g. because the reader was unplugged, receiving
+stops and the error is raised by the operation waiting for a response
+and by every later one.
+"""
+
+import asyncio
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import (
+  _TRACK_CNT, _open_device, Card, MSRX, ProtocolError, ResponseParser,
+  RetryPolicy, Timeout, DeviceError
+)
+
+class AsyncMSRX(object):
+
+  _POLL = MSRX._POLL
+
+  def __init__(self, device, retry=None):
+    '''Prepare to open device - the device is opened by open() or by
+    entering the object as an async context manager
+
+    retry: RetryPolicy for read, write and erase - defaults to no retries
+    '''
+    self.device = device
+    self.retry = retry or RetryPolicy()
+    self._dev = None
+    self._loop = None
+    self._io = None
+    self._reader = None
+    self._closing = threading.Event()
+    self._parser = ResponseParser()
+    self._events = None
+    self._lock = None
+    # What stopped receiving, raised by every operation from then on
+    self._error = None
+
+  async def open(self):
+    '''Open the device and start receiving from it'''
+    self._loop = asyncio.get_running_loop()
+    self._io = ThreadPoolExecutor(1)
+    self._events = asyncio.Queue()
+    self._lock = asyncio.Lock()
+    self._error = None
+    usb = self.device == 'usb'
+    self._dev = await self._loop.run_in_executor(
+      self._io, _open_device, self.device, self._POLL if usb else 0
+    )
+    if not usb:
+      try:
+        self._loop.add_reader(self._dev.fileno(), self._on_readable)
+        return self
+      except (AttributeError, NotImplementedError, io.UnsupportedOperation):
+        self._dev.timeout = self._POLL
+    self._closing.clear()
+    self._reader = threading.Thread(
+      target=self._read_thread, name='msrx-reader', daemon=True
+    )
+    self._reader.start()
+    return self
+
+  def close(self):
+    '''Stop receiving and close the device'''
+    if self._dev is None:
+      return
+    if self._reader is None:
+      self._loop.remove_reader(self._dev.fileno())
+    else:
+      self._closing.set()
+      self._reader.join()
+      self._reader = None
+    self._io.shutdown()
+    if hasattr(self._dev, 'close'):
+      self._dev.close()
+    self._dev = None
+
+  async def __aenter__(self):
+    return await self.open()
+
+  async def __aexit__(self, *exc):
+    self.close()
+
+  def _on_readable(self):
+    dev = self._dev
+    try:
+      chunk = dev.read(dev.in_waiting or 1)
+    except Exception as e:
+      # A hung up tty stays readable - stop watching it
+      self._loop.remove_reader(dev.fileno())
+      self._feed_error(e)
+      return
+    self._feed(chunk)
+
+  def _read_thread(self):
+    dev = self._dev
+    while not self._closing.is_set():
+      try:
+        if hasattr(dev, 'recv_message'):
+          chunk = dev.recv_message(timeout=int(self._POLL * 1000))
+        else:
+          chunk = dev.read(dev.in_waiting or 1)
+      except Exception as e:
+        self._loop.call_soon_threadsafe(self._feed_error, e)
+        return
+      if chunk:
+        self._loop.call_soon_threadsafe(self._feed, chunk)
+
+  def _feed(self, chunk):
+    try:
+      events = self._parser.feed(chunk)
+    except ProtocolError as e:
+      self._parser.reset()
+      events = [e]
+    for event in events:
+      self._events.put_nowait(event)
+
+  def _feed_error(self, e):
+    '''Receiving failed with e - nothing more will arrive'''
+    if not isinstance(e, OSError):
+      # termios errors get through pyserial from some calls
+      e = OSError(*e.args)
+    self._error = e
+    self._events.put_nowait(e)
+
+  async def _send(self, d):
+    await self._loop.run_in_executor(self._io, self._dev.write, d)
+
+  async def _command(self, d):
+    '''Send a command, dropping anything left over from earlier ones'''
+    self._parser.reset()
+    while not self._events.empty():
+      self._events.get_nowait()
+    if self._error is not None:
+      raise self._error
+    await self._send(d)
+
+  async def _expect(self, kind, track=None):
+    event = await self._events.get()
+    if isinstance(event, Exception):
+      raise event
+    return MSRX._check_event(event, kind, track)
+
+  async def _handle_status(self):
+    MSRX._check_status((await self._expect(ResponseParser.STATUS))[1])
+
+  async def _resync(self):
+    '''Abort the command in progress and drop any pending response'''
+    await self._send(b'\x1ba')
+    await asyncio.sleep(self._POLL)
+    # The reader thread owns the device's input side when there is one
+    if self._reader is None:
+      await self._loop.run_in_executor(
+        self._io, self._dev.reset_input_buffer
+      )
+    self._parser.reset()
+    while not self._events.empty():
+      self._events.get_nowait()
+
+  async def _attempts(self, func):
+    attempt = 0
+    while True:
+      attempt += 1
+      try:
+        return await func()
+      except DeviceError as e:
+        delay = self.retry.delay(e, attempt)
+        if delay is None:
+          raise
+      await asyncio.sleep(delay)
+
+  async def _run(self, func, timeout):
+    '''Run an operation under a deadline and the retry policy
+
+    Timeouts, cancellation and protocol errors leave the device in an
+    unknown state, so it is reset before the error is passed on.
+    '''
+    async with self._lock:
+      try:
+        return await asyncio.wait_for(self._attempts(func), timeout)
+      except asyncio.TimeoutError:
+        await self._resync()
+        raise Timeout('operation timed out')
+      except (asyncio.CancelledError, ProtocolError):
+        await asyncio.shield(self._resync())
+        raise
+
+  async def reset(self):
+    '''Reset device to initial state'''
+    await self._send(b'\x1ba')
+
+  async def hico(self):
+    '''set high coercion'''
+    await self._send(b'\x1bx')
+
+  async def loco(self):
+    '''set low coercion'''
+    await self._send(b'\x1by')
+
+  async def erase(self, tracks=(True, True, True), timeout=None):
+    '''Erase tracks - see MSRX.erase'''
+    async def erase():
+      await self._command(MSRX._erase_cmd(tracks))
+      await self._handle_status()
+    await self._run(erase, timeout)
+
+  async def read(self, timeout=None):
+    '''read() -> (t1, t2, t3) - see MSRX.read'''
+    async def read():
+      tracks = [b''] * _TRACK_CNT
+      await self._command(b'\x1bm')
+      await self._expect(ResponseParser.START)
+      for t in range(_TRACK_CNT):
+        event = await self._expect(ResponseParser.TRACK, t + 1)
+        tracks[t] = event[2]
+      await self._expect(ResponseParser.END)
+      await self._handle_status()
+      return Card._from_device(tracks)
+    return await self._run(read, timeout)
+
+  async def write(self, tracks, timeout=None):
+    '''Write all tracks - see MSRX.write'''
+    async def write():
+      await self._command(MSRX._write_cmd(tracks))
+      await self._handle_status()
+    await self._run(write, timeout)
@@ -0,0 +1,387 @@
+# archive.py - Append-only indexed archive of card swipes
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Append-only indexed archive of card swipes
+
+    with Archive('swipes.msra', 'a') as archive:
+      archive.append(tracks, '/dev/ttyUSB0')
+
+    archive = Archive('swipes.msra')
+    for record in archive.query('pan', '411111'):
+      print(record.time, record.device, record.tracks)
+
+The archive starts with MAGIC followed by one record per swipe: the
+time as a little endian double, the device id as an unsigned 16 bit
+integer and the length of each track as a byte, then the raw bytes of
+the three tracks. Device names are kept one per line, in id order, in
+PATH.devices next to the archive.
+
+Secondary indexes live in PATH.FIELD.idx and are brought up to date
+when queried: INDEX_MAGIC, the archive size covered by the index as an
+unsigned 64 bit integer, then fixed width entries of the key, padded
+with NULs, and the offset of its record, sorted by key. Keys added since
+are kept the same way in a small PATH.FIELD.idx.tail, which is merged
+into the main file only once it grows past Index.tail_limit entries, so
+a query after new swipes doesn't rewrite the whole index. A lookup is a
+binary search over both memory mapped files, so neither the archive nor
+the index is scanned. FIELDS lists the keys that can be indexed.
+"""
+
+import collections
+import io
+import mmap
+import os
+import struct
+import time
+
+from . import _TRACK_CNT, ISO7811
+
+MAGIC = b'MSRXARC\x01'
+INDEX_MAGIC = b'MSRXIDX\x01'
+
+_RECORD = struct.Struct('<dH%dB' % _TRACK_CNT)
+_COVERED = struct.Struct('<Q')
+
+Record = collections.namedtuple('Record', 'offset time device tracks')
+
+def _pan(tracks):
+  '''Primary account number from track 2'''
+  text = ISO7811.unpack(tracks[1], 2)[0]
+  if not text.startswith(';'):
+    return None
+  return text[1:].split('=')[0].split('?')[0] or None
+
+def _name(tracks):
+  '''Cardholder name from track 1'''
+  fields = ISO7811.unpack(tracks[0], 1)[0].split('^')
+  if len(fields) < 3 or not fields[0].startswith('%'):
+    return None
+  return fields[1].strip() or None
+
+# Indexable fields: (key width, function from tracks to key or None)
+FIELDS = {
+  'pan': (19, _pan),
+  'name': (26, _name)
+}
+
+class Archive(object):
+
+  def __init__(self, path, mode='r'):
+    '''Open the archive at path for reading ('r') or for appending as
+    well ('a'), creating it if needed'''
+    self.path = path
+    self._devices_path = path + '.devices'
+    if mode == 'a' and not os.path.exists(path):
+      with open(path, 'wb') as f:
+        f.write(MAGIC)
+    self._file = open(path, 'rb')
+    if self._file.read(len(MAGIC)) != MAGIC:
+      self._file.close()
+      raise ValueError('%s is not an msrx archive' % path)
+    self._map = None
+    self._devices = []
+    self._device_ids = {}
+    self._load_devices()
+    self._out = None
+    if mode == 'a':
+      self._out = open(path, 'ab')
+      # A crash can leave a truncated last record behind - cut it off so
+      # new records don't land after it
+      end = self._end(max(
+        [len(MAGIC)] + [Index(self, f).covered for f in self._indexes()]
+      ))
+      if end < os.path.getsize(path):
+        self._map.close()
+        self._map = None
+        self._out.truncate(end)
+        self._out.seek(0, os.SEEK_END)
+
+  def close(self):
+    if self._out is not None:
+      self._out.close()
+    if self._map is not None:
+      self._map.close()
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def _load_devices(self):
+    if not os.path.exists(self._devices_path):
+      return
+    with io.open(self._devices_path, encoding='utf-8') as f:
+      names = [l.rstrip('\n') for l in f]
+    for name in names[len(self._devices):]:
+      self._device_ids[name] = len(self._devices)
+      self._devices.append(name)
+
+  def _device_id(self, name):
+    if name not in self._device_ids:
+      with io.open(self._devices_path, 'a', encoding='utf-8') as f:
+        f.write(name + '\n')
+      self._device_ids[name] = len(self._devices)
+      self._devices.append(name)
+    return self._device_ids[name]
+
+  def _indexes(self):
+    prefix = os.path.basename(self.path) + '.'
+    return [
+      f[len(prefix):-len('.idx')]
+      for f in os.listdir(os.path.dirname(self.path) or '.')
+      if f.startswith(prefix) and f.endswith('.idx')
+      and f[len(prefix):-len('.idx')] in FIELDS
+    ]
+
+  def append(self, tracks, device='', stamp=None):
+    '''append(tracks, device='', stamp=None) -> offset
+
+    Append a swipe of raw tracks read by device at stamp (time.time()
+    by default) and return the offset of its record.
+    '''
+    if self._out is None:
+      raise ValueError('archive is not open for appending')
+    tracks = [bytes(t) for t in tracks]
+    if any(len(t) > 255 for t in tracks):
+      raise ValueError('tracks are limited to 255 bytes')
+    offset = self._out.tell()
+    self._out.write(b''.join(
+      [_RECORD.pack(
+        time.time() if stamp is None else stamp, self._device_id(device),
+        *[len(t) for t in tracks]
+      )] + tracks
+    ))
+    return offset
+
+  def flush(self):
+    '''Make the records appended so far visible to readers'''
+    self._out.flush()
+
+  def _mapped(self):
+    '''mmap of the archive, mapped again when it has grown'''
+    if self._out is not None:
+      self._out.flush()
+    size = os.fstat(self._file.fileno()).st_size
+    if self._map is None or len(self._map) != size:
+      # Iterators still walking the old map keep it alive
+      self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    return self._map
+
+  def _end(self, start):
+    '''Offset just past the last whole record, walking from start'''
+    buf = self._mapped()
+    pos = start
+    while pos + _RECORD.size <= len(buf):
+      size = _RECORD.size + sum(_RECORD.unpack_from(buf, pos)[2:])
+      if pos + size > len(buf):
+        break
+      pos += size
+    return pos
+
+  def at(self, offset):
+    '''The record at offset'''
+    return self._record(self._mapped(), offset)[0]
+
+  def _record(self, buf, pos):
+    '''(record at pos, offset of the next one), (None, pos) if there is
+    no whole record at pos'''
+    if pos + _RECORD.size > len(buf):
+      return None, pos
+    fields = _RECORD.unpack_from(buf, pos)
+    stamp, dev, lengths = fields[0], fields[1], fields[2:]
+    end = pos + _RECORD.size + sum(lengths)
+    if end > len(buf):
+      return None, pos
+    tracks, start = [], pos + _RECORD.size
+    for size in lengths:
+      tracks.append(buf[start:start + size])
+      start += size
+    if dev >= len(self._devices):
+      self._load_devices()
+    device = self._devices[dev] if dev < len(self._devices) else str(dev)
+    return Record(pos, stamp, device, tracks), end
+
+  def records(self, start=None):
+    '''Iterate over the records from offset start, the first by default'''
+    buf = self._mapped()
+    pos = len(MAGIC) if start is None else start
+    while True:
+      record, pos = self._record(buf, pos)
+      if record is None:
+        return
+      yield record
+
+  __iter__ = records
+
+  def index(self, field):
+    '''Index of field, brought up to date with the archive'''
+    index = Index(self, field)
+    index.update()
+    return index
+
+  def query(self, field, prefix):
+    '''Iterate over the records whose field starts with prefix, in key
+    order'''
+    for offset in self.index(field).lookup(prefix):
+      yield self.at(offset)
+
+class Index(object):
+  '''Index of a field: a large sorted main file and a small sorted tail
+  of the keys added since the tail was last merged into it'''
+
+  # Tail entries past which the tail is merged into the main file
+  tail_limit = 65536
+
+  def __init__(self, archive, field):
+    if field not in FIELDS:
+      raise ValueError(
+        'field must be one of %s' % ', '.join(sorted(FIELDS))
+      )
+    self.archive = archive
+    self.field = field
+    self.path = '%s.%s.idx' % (archive.path, field)
+    self.tail_path = self.path + '.tail'
+    self.width, self._key = FIELDS[field]
+    self._entry = struct.Struct('<%dsQ' % self.width)
+    self._header = len(INDEX_MAGIC) + _COVERED.size
+
+  def _covered(self, path):
+    '''Size of the archive the index file at path covers, None if it
+    doesn't exist or isn't an index'''
+    if not os.path.exists(path):
+      return None
+    with open(path, 'rb') as f:
+      header = f.read(self._header)
+    if len(header) < self._header \
+        or header[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+      return None
+    return _COVERED.unpack_from(header, len(INDEX_MAGIC))[0]
+
+  def _tail(self):
+    '''Whether the tail holds keys the main file doesn't - a tail left
+    behind by a merge that was cut short doesn't'''
+    tail = self._covered(self.tail_path)
+    return tail is not None and tail > (self._covered(self.path) or 0)
+
+  @property
+  def covered(self):
+    '''Size of the archive the index covers'''
+    covered = self._covered(self.path) or len(MAGIC)
+    if self._tail():
+      covered = self._covered(self.tail_path)
+    return covered
+
+  def _count(self, path):
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    return max(0, (size - self._header) // self._entry.size)
+
+  def _entries(self, path):
+    '''Entries of the index file at path as (key, offset), in key order'''
+    if self._covered(path) is None:
+      return
+    with open(path, 'rb') as f:
+      f.seek(self._header)
+      while True:
+        entry = f.read(self._entry.size)
+        if len(entry) < self._entry.size:
+          return
+        key, offset = self._entry.unpack(entry)
+        yield key.rstrip(b'\0'), offset
+
+  def _write(self, path, covered, entries):
+    '''Replace the index file at path atomically'''
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+      f.write(INDEX_MAGIC + _COVERED.pack(covered))
+      for key, offset in entries:
+        f.write(self._entry.pack(key, offset))
+    os.rename(tmp, path)
+
+  def update(self):
+    '''Add the records appended since the last update
+
+    New keys go to the tail, which is rewritten - the main file is only
+    rewritten when the tail grows past tail_limit entries.
+    '''
+    import heapq
+    covered = self.covered
+    new = []
+    end = covered
+    for record in self.archive.records(covered):
+      key = self._key(record.tracks)
+      if key is not None:
+        new.append((key.encode('ascii', 'replace')[:self.width],
+                    record.offset))
+      end = record.offset + _RECORD.size + sum(len(t) for t in record.tracks)
+    if end == covered:
+      return
+    new.sort()
+    tail = self._tail()
+    if (self._count(self.tail_path) if tail else 0) + len(new) \
+        <= self.tail_limit:
+      self._write(self.tail_path, end, heapq.merge(
+        self._entries(self.tail_path) if tail else iter(()), new
+      ))
+      return
+    # The main file covers everything once written, which leaves the
+    # tail stale even if removing it is cut short
+    self._write(self.path, end, heapq.merge(
+      self._entries(self.path),
+      self._entries(self.tail_path) if tail else iter(()),
+      new
+    ))
+    if os.path.exists(self.tail_path):
+      os.unlink(self.tail_path)
+
+  def _lookup(self, path, prefix):
+    '''(key, offset) of the entries of the index file at path whose key
+    starts with prefix, by binary search'''
+    count = self._count(path)
+    if count <= 0:
+      return []
+    with open(path, 'rb') as f:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      def key(i):
+        pos = self._header + i * self._entry.size
+        return buf[pos:pos + self.width].rstrip(b'\0')
+      lo, hi = 0, count
+      while lo < hi:
+        mid = (lo + hi) // 2
+        if key(mid) < prefix:
+          lo = mid + 1
+        else:
+          hi = mid
+      found = []
+      while lo < count and key(lo).startswith(prefix):
+        found.append((key(lo), self._entry.unpack_from(
+          buf, self._header + lo * self._entry.size
+        )[1]))
+        lo += 1
+      return found
+    finally:
+      buf.close()
+
+  def lookup(self, prefix):
+    '''Offsets of the records whose key starts with prefix'''
+    import heapq
+    prefix = prefix.encode('ascii')[:self.width]
+    found = self._lookup(self.path, prefix)
+    if self._tail():
+      found = heapq.merge(found, self._lookup(self.tail_path, prefix))
+    return [offset for _, offset in found]
@@ -0,0 +1,213 @@
+# batch.py - Vectorized track codecs for large sets of cards
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Vectorized track codecs for large sets of cards (requires NumPy)
+
+Each function converts many tracks of the same track number in one pass
+and produces the same bytes as the corresponding iso7811-tN and
+hex_codec conversions in msrx.cli._DATA_CONV.
+
+Raw tracks are passed around as a (rows, width) uint8 array, zero padded
+on the right, together with an array of row lengths. Text (ISO and hex)
+is passed around as NumPy 'S' arrays, one ASCII string per row.
+"""
+
+from __future__ import division
+from __future__ import unicode_literals
+
+import numpy as np
+
+from . import ISO7811
+
+_HEX = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+_UNHEX = np.zeros(256, dtype=np.uint8)
+_UNHEX[np.frombuffer(b'0123456789abcdef', dtype=np.uint8)] = np.arange(16)
+_UNHEX[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+_HEXDIGIT = np.zeros(256, dtype=bool)
+_HEXDIGIT[np.frombuffer(b'0123456789abcdefABCDEF', dtype=np.uint8)] = True
+
+def _tables(track):
+  '''NumPy versions of the ISO7811 lookup tables for a track'''
+  low, bits = ISO7811._PARAM_MAP[track]
+  chars, good, codes = ISO7811._tables(low, bits)
+  good_mask = np.zeros(256, dtype=bool)
+  good_mask[np.frombuffer(good, dtype=np.uint8)] = True
+  code_map = np.zeros(256, dtype=np.uint8)
+  code_map[list(codes)] = list(codes.values())
+  return (
+    low, bits, np.frombuffer(chars, dtype=np.uint8), good_mask, code_map
+  )
+
+def _to_rows(data, lengths=None):
+  '''_to_rows(data, lengths) -> (array, lengths)
+
+  Accept either a sequence of byte strings or a 2D uint8 array and
+  return a zero padded 2D uint8 array plus row lengths.
+  '''
+  if isinstance(data, np.ndarray) and data.ndim == 2:
+    data = np.ascontiguousarray(data, dtype=np.uint8)
+    if lengths is None:
+      lengths = np.full(len(data), data.shape[1], dtype=np.intp)
+    return data, np.asarray(lengths, dtype=np.intp)
+  data = list(data)
+  lengths = np.fromiter(map(len, data), dtype=np.intp, count=len(data))
+  width = int(lengths.max()) if len(data) else 0
+  rows = np.zeros((len(data), width), dtype=np.uint8)
+  flat = np.frombuffer(b''.join(bytes(d) for d in data), dtype=np.uint8)
+  rows[np.arange(width) < lengths[:, None]] = flat
+  return rows, lengths
+
+def _to_text(data):
+  '''Turn a sequence of str/bytes or a 'S'/'U' array into a 2D uint8
+  array of ASCII codes, zero padded on the right, and row lengths'''
+  if not (isinstance(data, np.ndarray) and data.dtype.kind == 'S'):
+    data = np.array([
+      d.encode('ascii') if not isinstance(d, bytes) else d for d in data
+    ], dtype=np.bytes_) if not isinstance(data, np.ndarray) \
+      else data.astype(np.bytes_)
+  data = np.ascontiguousarray(data.ravel())
+  width = data.dtype.itemsize
+  chars = data.view(np.uint8).reshape(len(data), width)
+  return chars, (chars != 0).sum(axis=1)
+
+def _from_rows(rows, lengths):
+  '''Mask out everything past each row length and view as 'S' array'''
+  rows = np.where(np.arange(rows.shape[1]) < lengths[:, None], rows, 0)
+  rows = np.ascontiguousarray(rows, dtype=np.uint8)
+  if rows.shape[1] == 0:
+    return np.zeros(len(rows), dtype='S1')
+  return rows.view('S%d' % rows.shape[1]).ravel()
+
+def to_tracks(rows, lengths):
+  '''Split a padded raw array back into a list of byte strings'''
+  return [bytes(r[:l].tobytes()) for r, l in zip(rows, lengths)]
+
+def encode_iso(tracks, track=1, lengths=None):
+  '''encode_iso(tracks, track, lengths) -> (text, bad, lrc)
+
+  Unpack raw track data into ISO characters - the batch equivalent of
+  ISO7811.unpack.
+
+  tracks: sequence of byte strings, or a 2D uint8 array with lengths
+  text: 'S' array with the decoded characters of each row
+  bad: 2D bool array marking characters with a bad parity bit
+  lrc: int8 array - 1 if the LRC matched, 0 if it didn't and -1 if
+       the row has no end sentinel or LRC
+  '''
+  low, bits, chars, good_mask, _ = _tables(track)
+  raw, lengths = _to_rows(tracks, lengths)
+  n = len(raw)
+  width = raw.shape[1] * 8 // bits
+  limit = lengths * 8 // bits
+  if width == 0:
+    # No row holds a whole character, e.g. a batch of empty tracks
+    return (np.zeros(n, dtype='S1'), np.zeros((n, 0), dtype=bool),
+            np.full(n, -1, dtype=np.int8))
+
+  bitrows = np.unpackbits(raw, axis=1, bitorder='little')
+  bitrows = bitrows[:, :width * bits].reshape(n, width, bits)
+  codes = (bitrows << np.arange(bits, dtype=np.uint8)).sum(
+    axis=2, dtype=np.uint8
+  )
+
+  # Decoding stops at the first null (or incomplete) character
+  idx = np.arange(width)
+  stop = (codes == 0) | (idx >= limit[:, None])
+  stop = np.concatenate([stop, np.ones((n, 1), dtype=bool)], axis=1)
+  length = stop.argmax(axis=1)
+  inside = idx < length[:, None]
+  codes = np.where(inside, codes, 0).astype(np.uint8)
+  text = chars[codes]
+
+  # LRC follows the end sentinel - anything beyond it isn't checked
+  dmask = (1 << (bits - 1)) - 1
+  sentinel = (text == ord(ISO7811._END_SENTINEL)) & inside
+  has_es = sentinel.any(axis=1)
+  es = sentinel.argmax(axis=1)
+  has_lrc = has_es & (es < length - 1)
+  acc = np.bitwise_xor.accumulate(codes & dmask, axis=1)
+  rows = np.arange(n)
+  lrc = np.full(n, -1, dtype=np.int8)
+  got = codes[rows, np.minimum(es + 1, width - 1)] & dmask
+  lrc[has_lrc] = (acc[rows, es] == got)[has_lrc]
+  checked = np.where(has_lrc, es + 2, length)
+  bad = ~good_mask[codes] & (idx < checked[:, None])
+
+  return _from_rows(text, length), bad, lrc
+
+def decode_iso(texts, track=1, strict=True):
+  '''decode_iso(texts, track, strict) -> (raw, lengths)
+
+  Pack ISO characters into raw track data, adding parity bits - the
+  batch equivalent of ISO7811.pack.
+
+  texts: sequence of str/bytes or a NumPy 'S'/'U' array
+  raw: 2D uint8 array, each row zero padded past its length
+  '''
+  low, bits, _, _, code_map = _tables(track)
+  chars, count = _to_text(texts)
+  n, width = chars.shape
+  inside = np.arange(width) < count[:, None]
+  hi = low + (1 << (bits - 1)) - 1
+  out = inside & ((chars < low) | (chars > hi))
+  if out.any():
+    if strict:
+      raise ValueError(
+        'characters must be between %r and %r (rows %s)' % (
+          chr(low), chr(hi),
+          ', '.join(map(str, np.flatnonzero(out.any(axis=1))))
+        )
+      )
+    chars = np.where(
+      inside, ((chars - low) & (hi - low)) + low, 0
+    ).astype(np.uint8)
+
+  codes = code_map[chars]
+  bitrows = (codes[:, :, None] >> np.arange(bits, dtype=np.uint8)) & 1
+  bitrows = bitrows.reshape(n, width * bits)
+  pad = -bitrows.shape[1] % 8
+  if pad:
+    bitrows = np.pad(bitrows, ((0, 0), (0, pad)))
+  raw = np.packbits(bitrows, axis=1, bitorder='little')
+  return raw, (count * bits + 7) // 8
+
+def encode_hex(tracks, lengths=None):
+  '''encode_hex(tracks, lengths) -> text
+
+  Hex encode raw track data into a 'S' array
+  '''
+  raw, lengths = _to_rows(tracks, lengths)
+  n, width = raw.shape
+  hexed = np.empty((n, width, 2), dtype=np.uint8)
+  hexed[:, :, 0] = _HEX[raw >> 4]
+  hexed[:, :, 1] = _HEX[raw & 15]
+  return _from_rows(hexed.reshape(n, width * 2), lengths * 2)
+
+def decode_hex(texts):
+  '''decode_hex(texts) -> (raw, lengths)
+
+  Decode hex text (str/bytes sequence or 'S'/'U' array) into raw data
+  '''
+  chars, count = _to_text(texts)
+  if (count % 2).any():
+    raise ValueError('odd-length hex string')
+  if not _HEXDIGIT[chars][np.arange(chars.shape[1]) < count[:, None]].all():
+    raise ValueError('non-hexadecimal digit found')
+  if chars.shape[1] % 2:
+    chars = np.pad(chars, ((0, 0), (0, 1)))
+  nibbles = _UNHEX[chars]
+  raw = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+  return raw.astype(np.uint8), count // 2
@@ -0,0 +1,340 @@
+# bench.py - Throughput benchmarks for the msrx hot paths
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Throughput benchmarks for the msrx hot paths
+
+    $ python -m msrx.bench                   # run and print
+    $ python -m msrx.bench --save            # also append to the results
+    $ python -m msrx.bench --check 0.1       # fail on a 10% regression
+
+Every benchmark reports operations per second, the best of several
+repeats. Results are stored one JSON object per line in the results
+file, and --check compares a run against the best stored result of each
+benchmark, so slowdowns too small to fail one at a time still add up to
+a failure. With both, a run is only saved if it passes the check. Device
+benchmarks run against msrx.emulator with no swipe latency, so they
+measure the host side only; the USB ones need pyusb and are skipped
+without it.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+from . import (
+  __progname__, __version__, _BITREV, _clock, _TRACK_CNT, ISO7811, MSRX
+)
+
+_DEF_RESULTS = 'bench-results.jsonl'
+
+# Typical full length tracks
+_SAMPLE = (
+  '%B4111111111111111^CARDHOLDER/EXAMPLE A^2512101000000000000000000?',
+  ';4111111111111111=25121010000000000000?',
+  ';011234567890123456789=000000000000000000000000000000000000000000000'
+  '00000000000000000000000000?'
+)
+
+_BENCHMARKS = []
+
+def _benchmark(func):
+  '''Register func as a benchmark
+
+  func() sets up and returns (run, count): run() is timed and performs
+  count operations. It may also return None to skip the benchmark.
+  '''
+  _BENCHMARKS.append((func.__name__, func))
+  return func
+
+def _iso_enc(track):
+  def iso_enc():
+    raw = ISO7811.pack(_SAMPLE[track - 1], track)
+    def run():
+      for _ in range(100):
+        ISO7811.unpack(raw, track)
+    return run, 100
+  iso_enc.__name__ = 'iso_enc_t%d' % track
+  return iso_enc
+
+def _iso_dec(track):
+  def iso_dec():
+    text = _SAMPLE[track - 1]
+    def run():
+      for _ in range(100):
+        ISO7811.pack(text, track)
+    return run, 100
+  iso_dec.__name__ = 'iso_dec_t%d' % track
+  return iso_dec
+
+def _iso_search(track):
+  def iso_search():
+    raw = ISO7811.pack(_SAMPLE[track - 1], track)
+    # Swiped backwards, after some clock bits
+    data = (b'\0\0' + raw)[::-1].translate(_BITREV)
+    def run():
+      for _ in range(100):
+        ISO7811.search(data, track)
+    return run, 100
+  iso_search.__name__ = 'iso_search_t%d' % track
+  return iso_search
+
+for _t in range(1, _TRACK_CNT + 1):
+  _benchmark(_iso_enc(_t))
+  _benchmark(_iso_dec(_t))
+  _benchmark(_iso_search(_t))
+
+# Backwards swipes, with their LRC, that the search once misread: the
+# bits in the forward direction make ';?4', which passes every check
+_SEARCH_REGRESSIONS = ((2, ';94954543048014?:'), (3, ';396341019084?:'))
+
+@_benchmark
+def iso_search_regressions():
+  cases = []
+  for track, text in _SEARCH_REGRESSIONS:
+    for clock in (b'', b'\0', b'\0\0'):
+      data = (clock + ISO7811.pack(text, track))[::-1].translate(_BITREV)
+      found = ISO7811.search(data, track)
+      if found is None or found[0] != text or found[1] or not found[2]:
+        raise ValueError('search of %r after %d clock bytes gave %r'
+                         % (text, len(clock), found))
+      cases.append((data, track))
+  def run():
+    for _ in range(10):
+      for data, track in cases:
+        ISO7811.search(data, track)
+  return run, 10 * len(cases)
+
+@_benchmark
+def bitrev():
+  tracks = [ISO7811.pack(text, t + 1) for t, text in enumerate(_SAMPLE)]
+  def run():
+    for _ in range(1000):
+      [d.translate(_BITREV) for d in tracks]
+  return run, 1000
+
+def _usb():
+  '''(usb_emulators, MSR605X), None without pyusb'''
+  try:
+    from .emulator import usb_emulators
+    from .msr605x import MSR605X
+  except ImportError:
+    return None
+  return usb_emulators, MSR605X
+
+def _read_response():
+  from .emulator import Emulator
+  tracks = [ISO7811.pack(text, t + 1) for t, text in enumerate(_SAMPLE)]
+  return Emulator(tracks)._read()
+
+@_benchmark
+def usb_encapsulate():
+  usb = _usb()
+  if usb is None:
+    return None
+  usb_emulators, MSR605X = usb
+  message = _read_response()
+  with usb_emulators(1):
+    dev = MSR605X()
+  def run():
+    for _ in range(100):
+      for _packet in dev._encapsulate_message(message):
+        pass
+  return run, 100
+
+@_benchmark
+def usb_recv_message():
+  usb = _usb()
+  if usb is None:
+    return None
+  usb_emulators, MSR605X = usb
+  message = _read_response()
+  with usb_emulators(1) as devices:
+    dev = MSR605X()
+    dev.connect()
+  emulated = devices[0]
+  def run():
+    for _ in range(100):
+      emulated._send(message)
+      dev.recv_message()
+  return run, 100
+
+def _round_trip(msrx, mode='raw'):
+  tracks = list(_SAMPLE)
+  if mode == 'raw':
+    tracks = [ISO7811.pack(text, t + 1) for t, text in enumerate(_SAMPLE)]
+  def run():
+    for _ in range(20):
+      msrx.write(tracks, mode=mode)
+      msrx.read(mode=mode)
+  return run, 20
+
+@_benchmark
+def round_trip_serial():
+  try:
+    from .emulator import PtyEmulator
+    emu = PtyEmulator()
+  except (ImportError, OSError):
+    return None
+  return _round_trip(MSRX(emu.port))
+
+@_benchmark
+def round_trip_serial_iso():
+  try:
+    from .emulator import PtyEmulator
+    emu = PtyEmulator()
+  except (ImportError, OSError):
+    return None
+  return _round_trip(MSRX(emu.port), mode='iso')
+
+@_benchmark
+def round_trip_usb():
+  usb = _usb()
+  if usb is None:
+    return None
+  with usb[0](1):
+    msrx = MSRX('usb')
+  return _round_trip(msrx)
+
+def run(pattern=None, repeat=5):
+  '''run(pattern=None, repeat=5) -> {name: ops per second}
+
+  Run the benchmarks whose name matches the regex pattern, keeping the
+  best of repeat timings of each.
+  '''
+  results = {}
+  for name, func in _BENCHMARKS:
+    if pattern and not re.search(pattern, name):
+      continue
+    setup = func()
+    if setup is None:
+      continue
+    func, count = setup
+    func()
+    best = None
+    for _ in range(repeat):
+      start = _clock()
+      func()
+      elapsed = _clock() - start
+      best = elapsed if best is None else min(best, elapsed)
+    results[name] = count / max(best, 1e-9)
+  return results
+
+def load(path):
+  '''Stored runs in path, oldest first'''
+  if not os.path.exists(path):
+    return []
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+def save(path, results):
+  with open(path, 'a') as f:
+    f.write(json.dumps({
+      'time': time.time(),
+      'version': __version__,
+      'python': platform.python_version(),
+      'results': results
+    }, sort_keys=True) + '\n')
+
+def best(runs):
+  '''{name: ops per second} of the fastest of runs for each benchmark'''
+  baseline = {}
+  for stored in runs:
+    for name, ops in stored['results'].items():
+      baseline[name] = max(ops, baseline.get(name, ops))
+  return baseline
+
+def regressions(results, baseline, threshold):
+  '''[(name, ops, baseline ops), ...] for results slower than baseline
+  by more than threshold (a fraction)'''
+  return [
+    (name, ops, baseline[name]) for name, ops in sorted(results.items())
+    if name in baseline and ops < baseline[name] * (1 - threshold)
+  ]
+
+def main():
+
+  parser = argparse.ArgumentParser(
+    description='Measure throughput of the %s hot paths' % __progname__
+  )
+  parser.add_argument(
+    '-k',
+    metavar='REGEX',
+    dest='pattern',
+    help='only run benchmarks matching REGEX'
+  )
+  parser.add_argument(
+    '-n', '--repeat',
+    metavar='N',
+    default=5,
+    type=int,
+    help='timings per benchmark, the best is kept - defaults to 5'
+  )
+  parser.add_argument(
+    '-r', '--results',
+    metavar='FILE',
+    default=_DEF_RESULTS,
+    help='where runs are stored - defaults to %s' % _DEF_RESULTS
+  )
+  parser.add_argument(
+    '-s', '--save',
+    action='store_true',
+    help='append this run to the results - with --check, only if it'
+         ' passes'
+  )
+  parser.add_argument(
+    '-c', '--check',
+    metavar='MARGIN',
+    type=float,
+    help='exit with 1 if any benchmark is slower than its best stored'
+         ' result by more than MARGIN (e.g. 0.1 for 10%%)'
+  )
+  args = parser.parse_args()
+
+  runs = load(args.results)
+  baseline = best(runs)
+  results = run(args.pattern, args.repeat)
+  for name, ops in sorted(results.items()):
+    if name in baseline:
+      print('%-20s %12.0f/s %+7.1f%%' % (
+        name, ops, (ops / baseline[name] - 1) * 100
+      ))
+    else:
+      print('%-20s %12.0f/s' % (name, ops))
+
+  # Checked before saving, so a regressed run never becomes a baseline
+  if args.check is not None:
+    if not runs:
+      print('%s: no stored results to check against in %s'
+            % (__progname__, args.results), file=sys.stderr)
+      exit(1)
+    slow = regressions(results, baseline, args.check)
+    for name, ops, base in slow:
+      print('%s: %s regressed: %.0f/s, best was %.0f/s'
+            % (__progname__, name, ops, base), file=sys.stderr)
+    if slow:
+      exit(1)
+
+  if args.save:
+    save(args.results, results)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,921 @@
+# cli.py - Command line interface to MSR605 magnetic card reader/writer
+# Copyright (C) 2014  Mansour Behabadi <mansour@oxplot.com>
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Command line interface to MSR605 magnetic card reader/writer
+
+Kept apart from the library so that importing msrx doesn't pay for
+argparse and the rest of the CLI. Modules that only some commands need
+are imported by those commands.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import codecs
+import collections
+import os
+import re
+import sys
+
+from . import (
+  __description__, __progname__, __verinfo__, _DEF_DEV, _DEF_TYPE, _DELIM,
+  _DEV_ENV, _TRACK_CNT, Cancelled, Card, DeviceError, MSRX,
+  ParityError, ProtocolError, RetryPolicy, unicode
+)
+
+try:
+  range = xrange
+  input = raw_input
+except NameError:
+  pass
+
+_DATA_CONV = {
+  ('raw', 'hex'):
+    (lambda d, _: codecs.encode(d, 'hex_codec').decode('ascii')),
+  ('hex', 'raw'): (lambda d, _: codecs.decode(d, 'hex_codec')),
+  ('raw', 'iso'):
+    (lambda d, t: codecs.encode(d, 'iso7811-t%d' % t)),
+  ('iso', 'raw'): (lambda d, t: codecs.decode(d, 'iso7811-t%d' % t))
+}
+
+_DTYPE_VFY = {
+  'hex': lambda d, _: bool(re.search(r'^[0-9a-fA-F]*$', d)),
+  'iso': lambda d, t: bool(
+    re.search(r'^[ -_]*$' if t == 1 else r'^[0-?]*$', d)
+  )
+}
+
+def _check_mode(args):
+
+  if args.mode == 'iso' and args.type != 'iso':
+    args.parser.error('--mode iso only works with --type iso')
+
+def _do_read(args):
+
+  _check_mode(args)
+  if args.search and (args.type != 'iso' or args.mode != 'raw'):
+    args.parser.error('--search only works with --type iso --mode raw')
+  if args.continuous:
+    if args.mode != 'raw':
+      args.parser.error('--continuous only works with --mode raw')
+    return _do_read_continuous(args)
+  if args.mode == 'iso':
+    print(_DELIM.join(args.msrx.read(timeout=args.timeout, mode='iso')))
+    return
+  tracks = args.msrx.read(timeout=args.timeout)
+  if args.search:
+    print(_DELIM.join(
+      _searched_track(tracks, t + 1) for t in range(_TRACK_CNT)
+    ))
+    return
+  print(_DELIM.join(
+    _DATA_CONV[('raw', args.type)](d, t + 1)
+    for d, t in zip(tracks, range(_TRACK_CNT))
+  ))
+
+def _searched_track(card, t):
+  '''Track t of card decoded with the sentinel search, raising
+  ParityError like the iso7811 codecs when it fails the checks'''
+  text, bad, lrc = card.decode(t, search=True)
+  if bad or lrc is False:
+    raise ParityError(text, bad, lrc)
+  return text
+
+def _track_status(card, t, dtype, search=False):
+  '''_track_status(card, t, dtype) -> (converted data, status)
+
+  status is as for Card.status.
+  '''
+  status = card.status(t, search)
+  if status == 'empty':
+    return '', status
+  return card.iso(t, search) if dtype == 'iso' else card.hex(t), status
+
+def _do_read_continuous(args):
+
+  import json
+
+  try:
+    for stamp, tracks, error in args.msrx.read_continuous(args.timeout):
+      tracks = [
+        _track_status(tracks, t + 1, args.type, args.search)
+        for t in range(_TRACK_CNT)
+      ]
+      status = 'ok' if error is None else error.code
+      if args.format == 'ndjson':
+        line = json.dumps({
+          'time': stamp,
+          'status': status,
+          'tracks': [{'data': d, 'status': s} for d, s in tracks]
+        })
+      else:
+        line = '%.3f\t%s\t%s\t%s' % (
+          stamp, status, _DELIM.join(d for d, _ in tracks),
+          ','.join(s for _, s in tracks)
+        )
+      print(line)
+      sys.stdout.flush()
+  except KeyboardInterrupt:
+    pass
+
+def _split_record(line, dtype):
+  '''Split a '|' delimited record and check each track against dtype
+
+  Raises ValueError if the record is malformed.
+  '''
+  data = line.split(_DELIM)
+  if len(data) != _TRACK_CNT:
+    raise ValueError(
+      "there must be exactly be %d '%s'"
+      " in data separating the %d tracks"
+      % (_TRACK_CNT - 1, _DELIM, _TRACK_CNT)
+    )
+  if not all(
+    _DTYPE_VFY[dtype](d, t + 1)
+    for d, t in zip(data, range(_TRACK_CNT))
+  ):
+    raise ValueError(
+      "the data doesn't match the type given (%s)" % dtype
+    )
+  return data
+
+def _parse_record(line, dtype, mode='raw'):
+  '''Split a '|' delimited record and convert each track to raw bytes,
+  or to ISO strings for mode 'iso'
+
+  Raises ValueError if the record is malformed.
+  '''
+  data = _split_record(line, dtype)
+  if mode == 'iso':
+    return data
+  return [
+    _DATA_CONV[dtype, 'raw'](d, t + 1)
+    for d, t in zip(data, range(_TRACK_CNT))
+  ]
+
+def _parse_tracks(data):
+  '''Turn a track selection like '1,3' into a list of bools'''
+  tracks = [False] * _TRACK_CNT
+  try:
+    selected = list(map(int, data.split(',')))
+  except ValueError:
+    raise ValueError(
+      'provide track numbers separated with commas - e.g 1,3'
+    )
+  for t in selected:
+    if t > _TRACK_CNT or t < 1:
+      raise ValueError(
+        'track numbers must be between %d and %d' % (1, _TRACK_CNT)
+      )
+    tracks[t - 1] = True
+  return tracks
+
+def _write_card(args, data):
+  '''Write a card, verifying it with --verify - returns the numbers of
+  the tracks that still don't read back right'''
+  if not args.verify:
+    args.msrx.write(data, timeout=args.timeout, mode=args.mode)
+    return []
+  result = args.msrx.write_verified(
+    data, timeout=args.timeout, mode=args.mode, attempts=args.verify
+  )
+  if result.ok and result.attempts > 1:
+    print('%s: verified after %d writes' % (__progname__, result.attempts),
+          file=sys.stderr)
+  return [t + 1 for t, st in enumerate(result.tracks) if st == 'mismatch']
+
+def _mismatch_message(tracks, attempts):
+  return '%s %s did not verify after %d writes' % (
+    'track' if len(tracks) == 1 else 'tracks',
+    ','.join(str(t) for t in tracks), attempts
+  )
+
+def _do_write(args):
+
+  _check_mode(args)
+  if args.verify is not None and args.verify < 1:
+    args.parser.error('--verify needs at least 1 write')
+  if args.batch:
+    return _do_write_batch(args)
+  try:
+    data = _parse_record(args.data or input(), args.type, args.mode)
+  except ValueError as e:
+    args.parser.error(e.args[0])
+  mismatch = _write_card(args, data)
+  if mismatch:
+    print('%s: error: %s' % (
+      __progname__, _mismatch_message(mismatch, args.verify)
+    ), file=sys.stderr)
+    exit(254)
+
+def _do_write_batch(args):
+
+  from .journal import Journal
+
+  # Check and encode every record before the first card is written so a
+  # bad record can't stop the run half way through.
+  records = []
+  for lineno, line in enumerate(args.batch, 1):
+    line = line.rstrip('\r\n')
+    if not line:
+      continue
+    try:
+      records.append(
+        (lineno, line, _parse_record(line, args.type, args.mode))
+      )
+    except ValueError as e:
+      args.parser.error('%s:%d: %s' % (args.batch.name, lineno, e.args[0]))
+
+  if args.journal is None and args.batch is sys.stdin:
+    args.parser.error('--journal is needed when the batch is read from stdin')
+  journal = Journal(args.journal or args.batch.name + '.journal')
+  todo = [r for r in records if not journal.is_done(r[0], r[1])]
+  if len(todo) < len(records):
+    print('%s: resuming, %d of %d records already written' % (
+      __progname__, len(records) - len(todo), len(records)
+    ), file=sys.stderr)
+
+  failed = 0
+  try:
+    for n, (lineno, line, data) in enumerate(todo, 1):
+      print('%s: card %d of %d (line %d), swipe card' % (
+        __progname__, n, len(todo), lineno
+      ), file=sys.stderr)
+      try:
+        mismatch = _write_card(args, data)
+      except DeviceError as e:
+        failed += 1
+        journal.record(lineno, line, e.code)
+        print('%s: line %d: error: %s' % (__progname__, lineno, e.args[0]),
+              file=sys.stderr)
+      else:
+        if mismatch:
+          failed += 1
+          journal.record(lineno, line, 'mismatch')
+          print('%s: line %d: error: %s' % (
+            __progname__, lineno, _mismatch_message(mismatch, args.verify)
+          ), file=sys.stderr)
+        else:
+          journal.record(lineno, line, 'ok')
+  finally:
+    journal.close()
+
+  if failed:
+    print('%s: %d of %d records failed, run again to retry them' % (
+      __progname__, failed, len(todo)
+    ), file=sys.stderr)
+    exit(254)
+
+def _do_erase(args):
+
+  args.msrx.erase(args.tracks, timeout=args.timeout)
+
+def _do_raw(args):
+  args.msrx.raw(args.data)
+
+def _convert_chunk(src, dst, lines):
+  '''Convert a list of records - returns a list of (output, error)'''
+  results = []
+  for line in lines:
+    try:
+      results.append((_DELIM.join(
+        _DATA_CONV['raw', dst](d, t + 1)
+        for d, t in zip(_parse_record(line, src), range(_TRACK_CNT))
+      ), None))
+    except ValueError as e:
+      results.append((None, e.args[0]))
+  return results
+
+def _ordered_imap(pool, func, iterable, window):
+  '''Like pool.imap but with at most `window` tasks in flight'''
+  pending = collections.deque()
+  for item in iterable:
+    pending.append(pool.apply_async(func, (item,)))
+    if len(pending) >= window:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+def _do_convert(args):
+
+  import functools
+  import itertools
+
+  lines = (l.rstrip('\r\n') for l in args.input)
+  chunks = iter(lambda: list(itertools.islice(lines, args.chunk)), [])
+  work = functools.partial(_convert_chunk, args.from_type, args.to_type)
+
+  pool = None
+  if args.jobs == 1:
+    results = map(work, chunks)
+  else:
+    import multiprocessing
+    jobs = args.jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs)
+    results = _ordered_imap(pool, work, chunks, jobs * 2)
+
+  failed = 0
+  lineno = 0
+  try:
+    for chunk in results:
+      out = []
+      for data, err in chunk:
+        lineno += 1
+        if err is None:
+          out.append(data + '\n')
+        else:
+          failed += 1
+          print('%s: line %d: %s' % (__progname__, lineno, err),
+                file=sys.stderr)
+      sys.stdout.write(''.join(out))
+    sys.stdout.flush()
+  finally:
+    if pool is not None:
+      pool.terminate()
+  if failed:
+    exit(1)
+
+def _do_farm(args):
+
+  from concurrent.futures import as_completed
+  from .farm import Farm, FarmError
+
+  farm = Farm(
+    args.devices.split(',') if args.devices else None,
+    retry=RetryPolicy(attempts=args.retries + 1, backoff=0.5),
+    timeout=args.timeout,
+    hico=args.hico,
+    reconnect=args.reconnect
+  )
+  if not farm.stats():
+    print('%s: error: no readers found' % __progname__, file=sys.stderr)
+    exit(1)
+
+  futures = {}
+  try:
+    for lineno, line in enumerate(args.input, 1):
+      op, _, arg = line.strip().partition(' ')
+      if not op:
+        continue
+      try:
+        if op == 'write':
+          arg = _parse_record(arg, args.type)
+        elif op == 'erase':
+          arg = _parse_tracks(arg) if arg else [True] * _TRACK_CNT
+        elif op == 'read':
+          arg = None
+        else:
+          raise ValueError('unknown job %s' % op)
+        futures[farm.submit(op, arg)] = (lineno, op)
+      except ValueError as e:
+        print('%d\t-\terror: %s' % (lineno, e.args[0]))
+
+    for future in as_completed(futures):
+      lineno, op = futures[future]
+      try:
+        device, value = future.result()
+        if op == 'read':
+          value = _DELIM.join(
+            _DATA_CONV[('raw', args.type)](d, t + 1)
+            for d, t in zip(value, range(_TRACK_CNT))
+          )
+        print('%d\t%s\t%s' % (lineno, device, value or 'ok'))
+      except (DeviceError, ProtocolError, ParityError, Cancelled,
+              FarmError, OSError) as e:
+        print('%d\t-\terror: %s' % (lineno, e))
+      sys.stdout.flush()
+  finally:
+    farm.close(wait=not futures or all(f.done() for f in futures))
+
+  for st in farm.stats():
+    print(
+      '%s: %s: %d jobs, %d errors, %.1f jobs/min%s' % (
+        __progname__, st['device'], st['jobs'], st['errors'], st['rate'],
+        '' if st['active'] else ' (dropped: %s)' % st['error']
+      ),
+      file=sys.stderr
+    )
+
+def _do_archive_append(args):
+
+  import json
+  from .archive import Archive
+
+  failed = 0
+  with Archive(args.archive, 'a') as archive:
+    for lineno, line in enumerate(args.input, 1):
+      line = line.rstrip('\r\n')
+      if not line:
+        continue
+      try:
+        if line.startswith('{'):
+          rec = json.loads(line)
+          stamp, data = rec['time'], [t['data'] for t in rec['tracks']]
+        else:
+          fields = line.split('\t')
+          stamp, data = float(fields[0]), fields[2].split(_DELIM)
+        if len(data) != _TRACK_CNT:
+          raise ValueError('expected %d tracks' % _TRACK_CNT)
+        archive.append([
+          _DATA_CONV[args.type, 'raw'](d, t + 1)
+          for d, t in zip(data, range(_TRACK_CNT))
+        ], args.device or args.dev, stamp)
+        # Swipes arrive one at a time from a pipe - don't let them sit in
+        # the buffer where a kill would lose them
+        archive.flush()
+      except (ValueError, KeyError, IndexError) as e:
+        failed += 1
+        print('%s: line %d: %s' % (__progname__, lineno, e),
+              file=sys.stderr)
+  if failed:
+    exit(1)
+
+def _print_records(args, records):
+
+  import json
+
+  for rec in records:
+    card = Card(rec.tracks)
+    tracks = [
+      _track_status(card, t + 1, args.type) for t in range(_TRACK_CNT)
+    ]
+    if args.format == 'ndjson':
+      line = json.dumps({
+        'time': rec.time,
+        'device': rec.device,
+        'tracks': [{'data': d, 'status': s} for d, s in tracks]
+      })
+    else:
+      line = '%.3f\t%s\t%s' % (
+        rec.time, rec.device, _DELIM.join(d for d, _ in tracks)
+      )
+    print(line)
+
+def _do_archive_query(args):
+
+  from .archive import Archive
+
+  with Archive(args.archive) as archive:
+    _print_records(args, archive.query(args.field, args.prefix))
+
+def _do_archive_export(args):
+
+  from .archive import Archive
+
+  with Archive(args.archive) as archive:
+    _print_records(args, archive)
+
+def _report_stats(args):
+
+  metrics = args.msrx.metrics
+  if args.stats_file:
+    metrics.write_textfile(args.stats_file, {'device': args.dev})
+  if not args.stats:
+    return
+  snap = metrics.snapshot()
+  for phase, st in sorted(snap['phases'].items()):
+    if st['count']:
+      print('%s: stats: %-8s %5d, mean %.1f ms, p50 <= %g ms,'
+            ' p99 <= %g ms' % (
+              __progname__, phase, st['count'], st['mean'] * 1000,
+              st['p50'] * 1000, st['p99'] * 1000
+            ), file=sys.stderr)
+  print('%s: stats: device errors %s, protocol errors %d, timeouts %d' % (
+    __progname__,
+    ', '.join('%s %d' % e for e in sorted(snap['device_errors'].items()))
+    or '0', snap['protocol_errors'], snap['timeouts']
+  ), file=sys.stderr)
+
+def main():
+
+  def track_sel_type(data):
+    try:
+      return _parse_tracks(data)
+    except ValueError as e:
+      raise argparse.ArgumentTypeError(e.args[0])
+
+  def add_mode_arg(parser):
+    parser.add_argument(
+      '-m', '--mode',
+      metavar='MODE',
+      default='raw',
+      choices=list(MSRX._MODES),
+      help="raw: the host packs and unpacks the track bits - iso: the"
+           ' device does it, for ISO-7811 data with --type iso only -'
+           ' defaults to raw'
+    )
+
+  def add_type_arg(parser):
+    parser.add_argument(
+      '-t', '--type',
+      metavar='TYPE',
+      default=_DEF_TYPE,
+      choices=list(_DTYPE_VFY),
+      type=unicode,
+      help='data type: %s - defaults to %s'
+           % (', '.join(_DTYPE_VFY), _DEF_TYPE)
+    )
+
+  if any(a == '--version' for a in sys.argv[1:]):
+    print(__verinfo__)
+    exit(0)
+
+  parser = argparse.ArgumentParser(
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description=__description__
+  )
+  parser.add_argument(
+    '-D', '--dev',
+    metavar='DEV',
+    default=os.environ.get(_DEV_ENV, _DEF_DEV),
+    help='serial device to use - can be override by %s env'
+         ' variable - defaults to %s' % (_DEV_ENV, _DEF_DEV)
+  )
+  parser.add_argument(
+    '-R', '--no-reset',
+    action='store_true',
+    default=False,
+    help='do NOT issue reset before the main command'
+  )
+  parser.add_argument(
+    '-H', '--hico',
+    action='store_true',
+    default=False,
+    help='Set Hi-Coercitivity mode'
+  )
+  parser.add_argument(
+    '-T', '--timeout',
+    metavar='SECONDS',
+    default=None,
+    type=float,
+    help='give up if the card is not swiped within SECONDS'
+  )
+  parser.add_argument(
+    '-r', '--retries',
+    metavar='N',
+    default=0,
+    type=int,
+    help='retry up to N times after swipe or read/write errors'
+  )
+  parser.add_argument(
+    '--reconnect',
+    metavar='SECONDS',
+    default=None,
+    type=float,
+    help='when the reader is lost (e.g. unplugged), wait up to SECONDS'
+         ' for it to come back and carry on'
+  )
+  parser.add_argument(
+    '--no-daemon',
+    action='store_true',
+    default=False,
+    help='open the device directly even if %sd is running' % __progname__
+  )
+  parser.add_argument(
+    '--trace',
+    metavar='FILE',
+    default=None,
+    help='record all traffic with the device to FILE, to be played back'
+         ' with -D replay:FILE - the device is opened directly, not'
+         ' through %sd' % __progname__
+  )
+  parser.add_argument(
+    '--stats',
+    action='store_true',
+    default=False,
+    help='print latency per phase and error counts to stderr when done'
+         ' - the device is opened directly, not through %sd'
+         % __progname__
+  )
+  parser.add_argument(
+    '--stats-file',
+    metavar='FILE',
+    default=None,
+    help='write the same stats to FILE in the Prometheus text format'
+  )
+  parser.add_argument(
+    '--version',
+    action='store_true',
+    help='show license and version of ' + __progname__
+  )
+
+  subparsers = parser.add_subparsers(
+    dest='cmd'
+  )
+
+  parser_a = subparsers.add_parser(
+    'read',
+    description='Read card and output data as'
+                " '%s' delimited string to stdout" % _DELIM,
+    help='read card'
+  )
+  add_type_arg(parser_a)
+  add_mode_arg(parser_a)
+  parser_a.add_argument(
+    '-c', '--continuous',
+    action='store_true',
+    default=False,
+    help='keep reading cards until interrupted (or until no card is'
+         ' swiped within --timeout), one line per swipe'
+  )
+  parser_a.add_argument(
+    '-f', '--format',
+    metavar='FORMAT',
+    default='text',
+    choices=['text', 'ndjson'],
+    help="output format with --continuous: text (time, status, '%s'"
+         ' delimited data and track statuses separated by tabs) or'
+         ' ndjson - defaults to text' % _DELIM
+  )
+  parser_a.add_argument(
+    '-s', '--search',
+    action='store_true',
+    default=False,
+    help='look for the start sentinel at every bit offset and in both'
+         ' directions, for tracks read with leading clock bits or swiped'
+         ' backwards - with --type iso only'
+  )
+  parser_a.set_defaults(func=_do_read)
+
+  parser_a = subparsers.add_parser(
+    'write',
+    description="Write to card from '%s' delimited data in stdin"
+                " or from --data command line arg" % _DELIM,
+    help='write card'
+  )
+  parser_a.add_argument(
+    '-d', '--data',
+    metavar='DATA',
+    default=None,
+    type=unicode,
+    help='data to write - overrides stdin'
+  )
+  parser_a.add_argument(
+    '-b', '--batch',
+    metavar='FILE',
+    default=None,
+    type=argparse.FileType('r'),
+    help="write one card per '%s' delimited line of FILE, resuming"
+         ' where an earlier run stopped' % _DELIM
+  )
+  parser_a.add_argument(
+    '-j', '--journal',
+    metavar='FILE',
+    default=None,
+    help='journal of written records for --batch - defaults to the'
+         ' batch file name with .journal appended'
+  )
+  parser_a.add_argument(
+    '-V', '--verify',
+    metavar='N',
+    nargs='?',
+    const=3,
+    default=None,
+    type=int,
+    help='read each card back after writing it and write the tracks that'
+         " don't match again, up to N writes in all - defaults to 3"
+  )
+  add_type_arg(parser_a)
+  add_mode_arg(parser_a)
+  parser_a.set_defaults(func=_do_write)
+
+  parser_a = subparsers.add_parser(
+    'erase',
+    description='Erase all tracks',
+    help='erase card'
+  )
+  parser_a.add_argument(
+    '-t', '--tracks',
+    metavar='TRACKS',
+    default=','.join(str(i + 1) for i in range(_TRACK_CNT)),
+    type=track_sel_type,
+    help='tracks to erase - default is '
+         + ','.join(str(i + 1) for i in range(_TRACK_CNT))
+  )
+  parser_a.set_defaults(func=_do_erase)
+
+  parser_a = subparsers.add_parser(
+    'raw',
+    description='Raw command',
+    help='Perform raw command'
+  )
+  parser_a.add_argument(
+    '-d', '--data',
+    metavar='DATA',
+    type=unicode,
+    help='data to write - overrides stdin'
+  )
+  parser_a.set_defaults(func=_do_raw)
+
+  parser_a = subparsers.add_parser(
+    'convert',
+    description="Convert '%s' delimited records from one data type to"
+                ' another, one record per line. Records that fail to'
+                ' convert are reported on stderr and skipped.' % _DELIM,
+    help='convert card data between types'
+  )
+  parser_a.add_argument(
+    'input',
+    metavar='FILE',
+    nargs='?',
+    default='-',
+    type=argparse.FileType('r'),
+    help='file to read records from - defaults to stdin'
+  )
+  parser_a.add_argument(
+    '-f', '--from',
+    dest='from_type',
+    metavar='TYPE',
+    required=True,
+    choices=list(_DTYPE_VFY),
+    type=unicode,
+    help='data type of the input: %s' % ', '.join(_DTYPE_VFY)
+  )
+  parser_a.add_argument(
+    '-t', '--to',
+    dest='to_type',
+    metavar='TYPE',
+    required=True,
+    choices=list(_DTYPE_VFY),
+    type=unicode,
+    help='data type of the output: %s' % ', '.join(_DTYPE_VFY)
+  )
+  parser_a.add_argument(
+    '-j', '--jobs',
+    metavar='N',
+    default=None,
+    type=int,
+    help='number of worker processes - defaults to the number of CPUs'
+  )
+  parser_a.add_argument(
+    '-c', '--chunk',
+    metavar='N',
+    default=1000,
+    type=int,
+    help='records handed to a worker at a time - defaults to 1000'
+  )
+  parser_a.set_defaults(func=_do_convert, no_dev=True)
+
+  parser_a = subparsers.add_parser(
+    'farm',
+    description='Run jobs from FILE, one per line, across many readers.'
+                " Jobs are 'read', 'erase [TRACKS]' and 'write DATA'"
+                " where DATA is '%s' delimited. Each result is printed"
+                ' as it completes, prefixed by its line number and the'
+                ' reader that ran it.' % _DELIM,
+    help='spread jobs over several readers'
+  )
+  parser_a.add_argument(
+    'input',
+    metavar='FILE',
+    nargs='?',
+    default='-',
+    type=argparse.FileType('r'),
+    help='file to read jobs from - defaults to stdin'
+  )
+  parser_a.add_argument(
+    '-d', '--devices',
+    metavar='DEVS',
+    default=None,
+    help='comma separated readers to use - defaults to every reader'
+         ' found'
+  )
+  add_type_arg(parser_a)
+  parser_a.set_defaults(func=_do_farm, no_dev=True)
+
+  parser_a = subparsers.add_parser(
+    'archive',
+    description='Keep swipes in an append-only archive, indexed for'
+                ' fast lookups',
+    help='archive swipes and look them up'
+  )
+  archive_parsers = parser_a.add_subparsers(dest='archive_cmd')
+  archive_parsers.required = True
+
+  def add_format_arg(parser):
+    parser.add_argument(
+      '-f', '--format',
+      metavar='FORMAT',
+      default='text',
+      choices=['text', 'ndjson'],
+      help="output format: text (time, device and '%s' delimited data"
+           ' separated by tabs) or ndjson - defaults to text' % _DELIM
+    )
+
+  parser_b = archive_parsers.add_parser(
+    'append',
+    description='Append the swipes printed by read --continuous, in'
+                ' either format, to the archive',
+    help='append swipes from read --continuous'
+  )
+  parser_b.add_argument('archive', metavar='ARCHIVE', help='archive file')
+  parser_b.add_argument(
+    'input',
+    metavar='FILE',
+    nargs='?',
+    default='-',
+    type=argparse.FileType('r'),
+    help='file to read swipes from - defaults to stdin'
+  )
+  parser_b.add_argument(
+    '-d', '--device',
+    metavar='NAME',
+    default=None,
+    help='reader to record the swipes under - defaults to --dev'
+  )
+  add_type_arg(parser_b)
+  parser_b.set_defaults(func=_do_archive_append, no_dev=True)
+
+  parser_b = archive_parsers.add_parser(
+    'query',
+    description='Print the archived swipes whose FIELD starts with'
+                ' PREFIX, using an index that is kept next to the'
+                ' archive',
+    help='look up swipes by an indexed field'
+  )
+  parser_b.add_argument('archive', metavar='ARCHIVE', help='archive file')
+  parser_b.add_argument('prefix', metavar='PREFIX', help='key prefix')
+  parser_b.add_argument(
+    '-k', '--field',
+    metavar='FIELD',
+    default='pan',
+    choices=['pan', 'name'],
+    help='pan (track 2 account number) or name (track 1 cardholder'
+         ' name) - defaults to pan'
+  )
+  add_type_arg(parser_b)
+  add_format_arg(parser_b)
+  parser_b.set_defaults(func=_do_archive_query, no_dev=True)
+
+  parser_b = archive_parsers.add_parser(
+    'export',
+    description='Print every archived swipe',
+    help='export all swipes'
+  )
+  parser_b.add_argument('archive', metavar='ARCHIVE', help='archive file')
+  add_type_arg(parser_b)
+  add_format_arg(parser_b)
+  parser_b.set_defaults(func=_do_archive_export, no_dev=True)
+
+  args = parser.parse_args()
+  args.parser = parser
+
+  try:
+    if getattr(args, 'no_dev', False):
+      args.func(args)
+      return
+
+    msrxinst = None
+    stats = args.stats or args.stats_file
+    if not args.no_daemon and not stats and not args.trace \
+        and args.cmd in ('read', 'write', 'erase'):
+      from .daemon import connect
+      msrxinst = connect(args.dev, retries=args.retries)
+    if msrxinst is None:
+      msrxinst = MSRX(
+        args.dev, retry=RetryPolicy(attempts=args.retries + 1, backoff=0.5),
+        trace=args.trace, reconnect=args.reconnect
+      )
+      msrxinst.on_reconnect = lambda lost, dev, secs: print(
+        '%s: %s reconnected%s after %.2f s' % (
+          __progname__, lost, '' if dev == lost else ' as ' + dev, secs
+        ), file=sys.stderr
+      )
+    args.msrx = msrxinst
+    try:
+      with msrxinst.session(
+        hico=True if args.hico else None, reset=not args.no_reset
+      ):
+        args.func(args)
+    finally:
+      if stats:
+        _report_stats(args)
+  except OSError as e:
+    print(
+      '%s: error: %s' % (
+        __progname__, os.strerror(e.errno) if e.errno else e
+      ),
+      file=sys.stderr
+    )
+  except (DeviceError, ProtocolError, ParityError, Cancelled) as e:
+    print('%s: error: %s' % (__progname__, e.args[0]), file=sys.stderr)
+    exit(254)
+  except KeyboardInterrupt:
+    print('keyboard interrupt', file=sys.stderr)
+    exit(255)
@@ -0,0 +1,551 @@
+# daemon.py - Keep MSR605 readers open and serve them over a local socket
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Keep MSR605 readers open and serve them over a local socket
+
+msrxd opens each reader once, on first use or at start up, and serves
+read, write and erase requests from any number of local clients over a
+Unix domain socket. Requests for the same reader are run one at a time.
+
+Every message in either direction is a 4 byte big endian length followed
+by that many bytes of JSON. Requests look like
+
+    {"op": "read", "dev": "/dev/ttyUSB0", "timeout": 30, "retries": 0}
+
+with "tracks" holding hex encoded track data for "write" and a list of
+bools for "erase". With "mode": "iso", "read" and "write" use the
+device's ISO commands and tracks are plain strings. "hico" (true or
+false) puts the reader in high or low coercivity for the request, so
+clients sharing a reader don't inherit each other's mode. Replies have
+"ok" set to true, plus "tracks" for "read", or false with "error"
+('device', 'timeout', 'cancelled', 'protocol' or 'os'), "message" and,
+for device errors, "code". Malformed requests get a 'protocol' error
+before any reader is touched; only 'os' errors close the reader, to be
+opened again by the next request.
+
+A request gives up when its client goes away, and the time spent
+waiting for a reader another client is using counts against its
+timeout.
+
+The socket lives in a directory only its user can get into. Clients
+only talk to a socket that the same user owns and serves.
+"""
+
+from __future__ import print_function
+
+import argparse
+import codecs
+import contextlib
+import json
+import os
+import select
+import socket
+import stat
+import struct
+import sys
+import threading
+import time
+
+try:
+  import socketserver
+except ImportError:
+  import SocketServer as socketserver
+
+from . import (
+  __progname__, _clock, _DEF_DEV, _DEV_ENV, _TRACK_CNT, _write_verified,
+  Cancelled, Card, DeviceError, MSRX, ProtocolError, RetryPolicy, Timeout,
+  unicode
+)
+
+_SOCK_ENV = 'MSRXD_SOCKET'
+
+def default_path():
+  '''Socket path from MSRXD_SOCKET, else in XDG_RUNTIME_DIR or in a
+  private directory in /tmp'''
+  if os.environ.get(_SOCK_ENV):
+    return os.environ[_SOCK_ENV]
+  if os.environ.get('XDG_RUNTIME_DIR'):
+    return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'msrxd.sock')
+  return '/tmp/msrxd-%d/msrxd.sock' % os.getuid()
+
+def _check_private(path):
+  '''Raise OSError unless path is a socket of ours in a directory that
+  other users can't put their own socket into'''
+  st = os.lstat(path)
+  if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+    raise OSError('%s is not a socket owned by this user' % path)
+  parent = os.stat(os.path.dirname(os.path.abspath(path)))
+  if parent.st_uid not in (0, os.getuid()) or (
+    parent.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    and not parent.st_mode & stat.S_ISVTX
+  ):
+    raise OSError('%s is in a directory other users can write to' % path)
+
+def _make_private_dir(path):
+  '''Create the directory of the socket at path if it's missing, private
+  to this user'''
+  parent = os.path.dirname(os.path.abspath(path))
+  if os.path.isdir(parent):
+    return
+  os.mkdir(parent, 0o700)
+  st = os.lstat(parent)
+  if st.st_uid != os.getuid() or st.st_mode & 0o077:
+    raise OSError('%s is not private to this user' % parent)
+
+def _peer_uid(sock):
+  '''User id of the process at the other end of sock, None if the
+  platform can't tell'''
+  if not hasattr(socket, 'SO_PEERCRED'):
+    return None
+  creds = sock.getsockopt(
+    socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')
+  )
+  return struct.unpack('3i', creds)[1]
+
+def _send_frame(sock, obj):
+  data = json.dumps(obj).encode('utf-8')
+  sock.sendall(struct.pack('>I', len(data)) + data)
+
+def _recv_exact(sock, size):
+  buf = bytearray()
+  while len(buf) < size:
+    chunk = sock.recv(size - len(buf))
+    if not chunk:
+      return None
+    buf += chunk
+  return bytes(buf)
+
+def _recv_frame(sock):
+  '''Next message from sock, None once the peer has closed it'''
+  header = _recv_exact(sock, 4)
+  if header is None:
+    return None
+  data = _recv_exact(sock, struct.unpack('>I', header)[0])
+  if data is None:
+    return None
+  return json.loads(data.decode('utf-8'))
+
+def _hex(tracks):
+  return [codecs.encode(t, 'hex_codec').decode('ascii') for t in tracks]
+
+def _unhex(tracks):
+  return [codecs.decode(t, 'hex_codec') for t in tracks]
+
+def _dump(tracks, mode):
+  return list(tracks) if mode == 'iso' else _hex(tracks)
+
+def _load(tracks, mode):
+  return list(tracks) if mode == 'iso' else Card(_unhex(tracks))
+
+_OPS = ('read', 'write', 'erase', 'reset', 'hico', 'loco')
+
+def _parse(req):
+  '''(dev, op, mode, tracks) of a request, with the tracks to write
+  ready for the device - raises ValueError if it is malformed, before
+  the device is touched'''
+  if not isinstance(req, dict):
+    raise ValueError('request is not an object')
+  name = req.get('dev', os.environ.get(_DEV_ENV, _DEF_DEV))
+  op = req.get('op')
+  mode = req.get('mode', 'raw')
+  tracks = req.get('tracks')
+  if not isinstance(name, (str, unicode)):
+    raise ValueError('dev must be a string')
+  if op not in _OPS:
+    raise ValueError('unknown op %s' % op)
+  if mode not in MSRX._MODES:
+    raise ValueError('unknown mode %s' % mode)
+  for key, types in (('timeout', (int, float)), ('retries', int)):
+    value = req.get(key)
+    if value is not None and (
+      isinstance(value, bool) or not isinstance(value, types) or value < 0
+    ):
+      raise ValueError('%s must be a number of at least 0' % key)
+  if req.get('hico') not in (None, True, False):
+    raise ValueError('hico must be true or false')
+  if op in ('write', 'erase'):
+    if not isinstance(tracks, list) or len(tracks) != _TRACK_CNT:
+      raise ValueError('tracks must be a list of %d' % _TRACK_CNT)
+  if op == 'write':
+    if not all(isinstance(t, unicode) for t in tracks):
+      raise ValueError('tracks must be strings')
+    try:
+      if mode == 'iso':
+        for t in tracks:
+          t.encode('ascii')
+      else:
+        tracks = _load(tracks, mode)
+    except (TypeError, ValueError) as e:
+      raise ValueError('bad track data: %s' % e)
+  return name, op, mode, tracks
+
+class _Watch(object):
+  '''Watch the client of a request while it runs, cancelling the
+  operation in progress if the client goes away'''
+
+  def __init__(self, sock):
+    self.gone = threading.Event()
+    self._sock = sock
+    self._lock = threading.Lock()
+    self._msrx = None
+    self._done = threading.Event()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    if sock is not None:
+      self._thread.start()
+
+  def _run(self):
+    while not self._done.is_set():
+      try:
+        readable = select.select([self._sock], [], [], MSRX._POLL)[0]
+        if not readable:
+          continue
+        # Anything but the end of the stream is the next request
+        if self._sock.recv(1, socket.MSG_PEEK):
+          return
+      except (OSError, ValueError, select.error):
+        pass
+      self.gone.set()
+      # Keep at it as an operation that is just starting clears earlier
+      # cancels
+      while not self._done.is_set():
+        with self._lock:
+          if self._msrx is not None:
+            self._msrx.cancel()
+        self._done.wait(MSRX._POLL)
+      return
+
+  def running(self, msrx):
+    '''msrx started the operation - returns False if the client is
+    already gone'''
+    with self._lock:
+      self._msrx = msrx
+      return not self.gone.is_set()
+
+  def finish(self):
+    '''The operation is over - called before the reader is released so
+    a late cancel() can't hit the next client's operation'''
+    with self._lock:
+      self._msrx = None
+      self._done.set()
+
+class Daemon(object):
+
+  def __init__(self, path=None, devices=()):
+    '''Listen on path (default_path() by default) and open devices'''
+    self.path = path or default_path()
+    self._lock = threading.Lock()
+    self._devices = {}
+    for device in devices:
+      self._device(device)
+
+  def _device(self, name):
+    '''(MSRX, lock) for name, opening the device on first use'''
+    with self._lock:
+      if name not in self._devices:
+        msrx = MSRX(name)
+        try:
+          msrx.reset()
+        except OSError:
+          msrx.close()
+          raise
+        self._devices[name] = (msrx, threading.Lock())
+      return self._devices[name]
+
+  def _forget(self, name, msrx):
+    '''Close msrx and open name again next time'''
+    with self._lock:
+      if self._devices.get(name, (None,))[0] is msrx:
+        del self._devices[name]
+    msrx.close()
+
+  def _current(self, name, msrx):
+    with self._lock:
+      return self._devices.get(name, (None,))[0] is msrx
+
+  @staticmethod
+  def _acquire(lock, deadline, watch):
+    '''Wait for lock until deadline (None for no limit) or until the
+    client goes away'''
+    while True:
+      wait = MSRX._POLL
+      if deadline is not None:
+        wait = min(wait, deadline - _clock())
+        if wait <= 0:
+          raise Timeout('reader busy with another client')
+      if lock.acquire(True, wait):
+        return
+      if watch.gone.is_set():
+        raise Cancelled('client went away')
+
+  def dispatch(self, req, sock=None):
+    '''Run one request and return the reply
+
+    sock: the client's socket, to cancel the operation if it closes
+    '''
+    try:
+      name, op, mode, tracks = _parse(req)
+    except ValueError as e:
+      return {'ok': False, 'error': 'protocol', 'message': str(e)}
+    watch = _Watch(sock)
+    try:
+      timeout = req.get('timeout')
+      deadline = None if timeout is None else _clock() + timeout
+      while True:
+        try:
+          msrx, lock = self._device(name)
+        except (OSError, ValueError) as e:
+          return {'ok': False, 'error': 'os',
+                  'errno': getattr(e, 'errno', None), 'message': str(e)}
+        self._acquire(lock, deadline, watch)
+        # Another client's request may have lost the reader meanwhile
+        if self._current(name, msrx):
+          break
+        lock.release()
+      try:
+        if not watch.running(msrx):
+          raise Cancelled('client went away')
+        if deadline is not None:
+          timeout = max(0, deadline - _clock())
+        msrx.retry = RetryPolicy(
+          attempts=(req.get('retries') or 0) + 1, backoff=0.5
+        )
+        if req.get('hico') is not None \
+            and op not in ('reset', 'hico', 'loco'):
+          msrx.hico() if req['hico'] else msrx.loco()
+        if op == 'read':
+          return {'ok': True, 'tracks': _dump(
+            msrx.read(timeout=timeout, mode=mode), mode
+          )}
+        elif op == 'write':
+          msrx.write(tracks, timeout=timeout, mode=mode)
+        elif op == 'erase':
+          msrx.erase(tracks, timeout=timeout)
+        else:
+          getattr(msrx, op)()
+      except OSError:
+        # The device is gone - open it again next time, releasing it now
+        # rather than whenever the MSRX happens to be collected
+        self._forget(name, msrx)
+        raise
+      finally:
+        watch.finish()
+        lock.release()
+      return {'ok': True}
+    except DeviceError as e:
+      return {'ok': False, 'error': 'device', 'code': e.code,
+              'message': e.args[0],
+              'tracks': _dump(getattr(e, 'tracks', [b''] * _TRACK_CNT),
+                              mode)}
+    except Timeout as e:
+      return {'ok': False, 'error': 'timeout', 'message': e.args[0]}
+    except Cancelled as e:
+      return {'ok': False, 'error': 'cancelled', 'message': e.args[0]}
+    except ProtocolError as e:
+      return {'ok': False, 'error': 'protocol', 'message': e.args[0]}
+    except OSError as e:
+      return {'ok': False, 'error': 'os', 'errno': getattr(e, 'errno', None),
+              'message': str(e)}
+    except ValueError as e:
+      return {'ok': False, 'error': 'protocol', 'message': str(e)}
+    finally:
+      watch.finish()
+
+  def serve_forever(self):
+    daemon = self
+
+    class Handler(socketserver.BaseRequestHandler):
+      def handle(self):
+        while True:
+          try:
+            req = _recv_frame(self.request)
+          except ValueError as e:
+            # The frame was read whole, so the next one still lines up
+            reply = {'ok': False, 'error': 'protocol',
+                     'message': 'bad request: %s' % e}
+          else:
+            if req is None:
+              return
+            reply = daemon.dispatch(req, self.request)
+          try:
+            _send_frame(self.request, reply)
+          except socket.error:
+            return
+
+    _make_private_dir(self.path)
+    if os.path.exists(self.path):
+      if connect_socket(self.path) is not None:
+        raise OSError('%s is already serving %s' % (__progname__ + 'd',
+                                                     self.path))
+      os.unlink(self.path)
+    # Created without access for others from the start, rather than
+    # opened up to chmod after bind
+    umask = os.umask(0o177)
+    try:
+      server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+    finally:
+      os.umask(umask)
+    server.daemon_threads = True
+    try:
+      server.serve_forever()
+    finally:
+      server.server_close()
+      os.unlink(self.path)
+
+def connect_socket(path=None):
+  '''Connected socket to a running msrxd, None if there's none'''
+  path = path or default_path()
+  if not os.path.exists(path):
+    return None
+  # Another user's socket would see every track read or written
+  _check_private(path)
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except socket.error:
+    sock.close()
+    return None
+  if _peer_uid(sock) not in (None, os.getuid()):
+    sock.close()
+    raise OSError('%s is served by another user' % path)
+  return sock
+
+class RemoteMSRX(object):
+  '''Same interface as MSRX, served by msrxd'''
+
+  def __init__(self, device, sock, retries=0):
+    self.device = device
+    self.retries = retries
+    self._sock = sock
+    # Sent with every request as the reader is shared with other clients
+    # - a fresh reader is in low coercivity
+    self._hico = False
+
+  def _call(self, op, **kwargs):
+    kwargs.update(
+      op=op, dev=self.device, retries=self.retries, hico=self._hico
+    )
+    _send_frame(self._sock, kwargs)
+    reply = _recv_frame(self._sock)
+    if reply is None:
+      raise ProtocolError('%sd closed the connection' % __progname__)
+    if reply['ok']:
+      return reply
+    error, message = reply['error'], reply['message']
+    if error == 'device':
+      e = DeviceError(reply['code'])
+      e.tracks = _load(reply['tracks'], kwargs.get('mode', 'raw'))
+      raise e
+    elif error == 'timeout':
+      raise Timeout(message)
+    elif error == 'cancelled':
+      raise Cancelled(message)
+    elif error == 'os':
+      raise OSError(reply.get('errno'), message)
+    raise ProtocolError(message)
+
+  def close(self):
+    self._sock.close()
+
+  def reset(self):
+    self._call('reset')
+
+  def hico(self):
+    '''Use high coercivity for the following requests'''
+    self._hico = True
+
+  def loco(self):
+    '''Use low coercivity for the following requests'''
+    self._hico = False
+
+  @contextlib.contextmanager
+  def session(self, hico=None, reset=True):
+    '''See MSRX.session - the coercivity goes with each request, so
+    other clients of the reader keep their own'''
+    before = self._hico
+    if reset:
+      self.reset()
+    if hico is not None:
+      self._hico = bool(hico)
+    try:
+      yield self
+    finally:
+      self._hico = before
+
+  def erase(self, tracks=(True, True, True), timeout=None):
+    self._call('erase', tracks=list(tracks), timeout=timeout)
+
+  def read(self, timeout=None, mode='raw'):
+    return _load(
+      self._call('read', timeout=timeout, mode=mode)['tracks'], mode
+    )
+
+  def write(self, tracks, timeout=None, mode='raw'):
+    self._call('write', tracks=_dump(tracks, mode), timeout=timeout,
+               mode=mode)
+
+  def write_verified(self, tracks, timeout=None, mode='raw', attempts=3):
+    '''See MSRX.write_verified - the writes and reads are separate
+    requests, so other clients can use the reader in between'''
+    return _write_verified(self, tracks, timeout, mode, attempts)
+
+  def read_continuous(self, timeout=None):
+    '''See MSRX.read_continuous - ends when timeout runs out'''
+    while True:
+      try:
+        tracks, error = self.read(timeout=timeout), None
+      except DeviceError as e:
+        tracks, error = e.tracks, e
+      except Cancelled:
+        return
+      yield time.time(), tracks, error
+
+def connect(device, path=None, retries=0):
+  '''RemoteMSRX for device if msrxd is running, otherwise None'''
+  sock = connect_socket(path)
+  if sock is None:
+    return None
+  return RemoteMSRX(device, sock, retries=retries)
+
+def main():
+
+  parser = argparse.ArgumentParser(
+    description='Keep MSR605 readers open and serve them to local'
+                ' clients, including %s itself, over a Unix socket'
+                % __progname__
+  )
+  parser.add_argument(
+    '-s', '--socket',
+    metavar='PATH',
+    default=default_path(),
+    help='socket to listen on - can be set with the %s env variable -'
+         ' defaults to %s' % (_SOCK_ENV, default_path())
+  )
+  parser.add_argument(
+    'devices',
+    metavar='DEV',
+    nargs='*',
+    help='devices to open at start up - others are opened on first use'
+  )
+  args = parser.parse_args()
+
+  try:
+    Daemon(args.socket, args.devices).serve_forever()
+  except OSError as e:
+    print('%sd: error: %s' % (__progname__, e), file=sys.stderr)
+    exit(1)
+  except KeyboardInterrupt:
+    pass
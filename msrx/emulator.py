@@ -0,0 +1,494 @@
+# emulator.py - Hardware-free stand in for MSR605/MSR605X readers
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Hardware-free stand in for MSR605/MSR605X readers
+
+Emulator speaks the subset of the MSR605 command set MSRX uses. Every
+command that needs a card completes swipe_latency seconds after it
+arrives, using the emulated card in the slot. Errors can be queued up
+for the next swipes with fail().
+
+It can be reached like a real reader in two ways:
+
+    with PtyEmulator() as emu:            # serial, POSIX only
+      msrx = MSRX(emu.port)
+
+    with usb_emulators(2) as emus:        # MSR605X over fake usb.core
+      msrx = MSRX('usb')                  # or 'usb:BUS:ADDRESS'
+
+Running the module serves emulated serial readers until interrupted:
+
+    $ python -m msrx.emulator -n 4 --latency 0.2
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import os
+import threading
+import time
+
+from . import _BITREV, _TRACK_CNT, _USB_IDS, ISO7811
+
+ESC = b'\x1b'
+
+class Emulator(object):
+
+  def __init__(self, card=None, swipe_latency=0.0):
+    '''card: the three raw tracks of the card in the slot, as MSRX.read
+    returns them - defaults to a blank card
+    swipe_latency: seconds between a command and the emulated swipe
+    '''
+    self.card = list(card or [b''] * _TRACK_CNT)
+    self.swipe_latency = swipe_latency
+    self.coercivity = 'lo'
+    self.output = lambda data: None
+    self.swipes = 0
+    self._failures = []
+    self._buf = bytearray()
+    self._lock = threading.Lock()
+    self._pending = None
+
+  def fail(self, code, count=1):
+    '''Answer the next count swipes with status code (e.g. b'9')'''
+    with self._lock:
+      self._failures.extend([code] * count)
+
+  def feed(self, data):
+    '''Process bytes sent by the host'''
+    with self._lock:
+      self._buf += data
+      while self._command():
+        pass
+
+  def _command(self):
+    '''Consume one complete command from the buffer, if there is one'''
+    buf = self._buf
+    if len(buf) < 2:
+      return False
+    if buf[0:1] != ESC:
+      del buf[:1]
+      return True
+    cmd = buf[1:2]
+    if cmd == b'a':
+      self._cancel()
+      self.coercivity = 'lo'
+      del buf[:2]
+    elif cmd == b'e':
+      del buf[:2]
+      self.output(ESC + b'y')
+    elif cmd == b'v':
+      del buf[:2]
+      self.output(ESC + b'REVEM1.00')
+    elif cmd in (b'x', b'y'):
+      self.coercivity = 'hi' if cmd == b'x' else 'lo'
+      del buf[:2]
+    elif cmd == b'm':
+      del buf[:2]
+      self._arm(self._read)
+    elif cmd == b'r':
+      del buf[:2]
+      self._arm(self._read_iso)
+    elif cmd == b'c':
+      if len(buf) < 3:
+        return False
+      mask = buf[2]
+      del buf[:3]
+      self._arm(self._erase(mask))
+    elif cmd == b'n':
+      tracks, size = self._parse_write(buf)
+      if tracks is None:
+        return size is not None and self._reject(size)
+      del buf[:size]
+      self._arm(self._write(tracks))
+    elif cmd == b'w':
+      tracks, size = self._parse_write_iso(buf)
+      if tracks is None:
+        return size is not None and self._reject(size)
+      del buf[:size]
+      self._arm(self._write([
+        ISO7811.pack(d.decode('ascii'), t + 1)
+        for d, t in zip(tracks, range(_TRACK_CNT))
+      ]))
+    else:
+      del buf[:2]
+      self.output(ESC + b'2')
+    return True
+
+  @staticmethod
+  def _parse_write(buf):
+    '''(tracks, size) of a complete write command, (None, None) if it is
+    incomplete and (None, size) if it is malformed'''
+    if len(buf) < 4:
+      return None, None
+    if buf[2:4] != ESC + b's':
+      return None, 2
+    pos, tracks = 4, []
+    for t in range(_TRACK_CNT):
+      if len(buf) < pos + 3:
+        return None, None
+      if buf[pos:pos + 1] != ESC or buf[pos + 1] != t + 1:
+        return None, pos
+      end = pos + 3 + buf[pos + 2]
+      if len(buf) < end:
+        return None, None
+      tracks.append(bytes(buf[pos + 3:end]))
+      pos = end
+    if len(buf) < pos + 2:
+      return None, None
+    if buf[pos:pos + 2] != b'?\x1c':
+      return None, pos
+    return tracks, pos + 2
+
+  @staticmethod
+  def _parse_write_iso(buf):
+    '''Same as _parse_write, for ISO writes'''
+    if len(buf) < 4:
+      return None, None
+    if buf[2:4] != ESC + b's':
+      return None, 2
+    starts = []
+    for t in range(_TRACK_CNT):
+      pos = buf.find(ESC + bytes(bytearray([t + 1])), starts[-1] if starts
+                     else 4)
+      if pos < 0:
+        return None, None
+      starts.append(pos + 2)
+    end = buf.find(b'?\x1c', starts[-1])
+    if end < 0:
+      return None, None
+    bounds = starts + [end + 2]
+    tracks = [bytes(buf[a:b - 2]) for a, b in zip(bounds, bounds[1:])]
+    try:
+      [ISO7811.pack(d.decode('ascii'), t + 1)
+       for d, t in zip(tracks, range(_TRACK_CNT))]
+    except ValueError:
+      return None, end + 2
+    return tracks, end + 2
+
+  def _reject(self, size):
+    del self._buf[:size]
+    self.output(ESC + b'2')
+    return True
+
+  def _arm(self, complete):
+    '''Answer with complete(status) once the emulated swipe happens'''
+    self._cancel()
+    timer = threading.Timer(self.swipe_latency, self._swipe, (complete,))
+    timer.daemon = True
+    self._pending = timer
+    timer.start()
+
+  def _cancel(self):
+    if self._pending is not None:
+      self._pending.cancel()
+      self._pending = None
+
+  def _swipe(self, complete):
+    with self._lock:
+      if self._pending is not threading.current_thread():
+        return
+      self._pending = None
+      self.swipes += 1
+      status = self._failures.pop(0) if self._failures else b'0'
+      self.output(complete(status))
+
+  def _read(self, status=b'0'):
+    return b''.join(
+      [ESC + b's']
+      + [ESC + bytes(bytearray([t + 1, len(d)])) + d.translate(_BITREV)
+         for d, t in zip(self.card, range(_TRACK_CNT))]
+      + [b'?\x1c', ESC + status]
+    )
+
+  def _read_iso(self, status=b'0'):
+    texts = []
+    for d, t in zip(self.card, range(_TRACK_CNT)):
+      text = ISO7811.unpack(d, t + 1)[0]
+      es = text.find(ISO7811._END_SENTINEL)
+      texts.append(text[:es + 1] if es >= 0 else text)
+    return b''.join(
+      [ESC + b's']
+      + [ESC + bytes(bytearray([t + 1])) + d.encode('ascii')
+         for d, t in zip(texts, range(_TRACK_CNT))]
+      + [b'?\x1c', ESC + status]
+    )
+
+  def _write(self, tracks):
+    def complete(status):
+      if status == b'0':
+        self.card = [
+          d if d else old for d, old in zip(tracks, self.card)
+        ]
+      return ESC + status
+    return complete
+
+  def _erase(self, mask):
+    def complete(status):
+      if status == b'0':
+        self.card = [
+          b'' if mask & (1 << t) else d
+          for d, t in zip(self.card, range(_TRACK_CNT))
+        ]
+      return ESC + status
+    return complete
+
+class PtyEmulator(object):
+  '''Emulated serial reader behind a pseudo terminal (POSIX only)'''
+
+  def __init__(self, emulator=None):
+    import tty
+    self.emulator = emulator or Emulator()
+    self._master, self._slave = os.openpty()
+    tty.setraw(self._master)
+    tty.setraw(self._slave)
+    self.port = os.ttyname(self._slave)
+    self.emulator.output = lambda data: os.write(self._master, data)
+    self._thread = threading.Thread(target=self._serve, name='msrx-pty')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _serve(self):
+    while True:
+      try:
+        data = os.read(self._master, 4096)
+      except OSError:
+        return
+      if not data:
+        return
+      self.emulator.feed(data)
+
+  def close(self):
+    self.emulator.output = lambda data: None
+    os.close(self._master)
+    os.close(self._slave)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class _Endpoint(object):
+
+  def __init__(self, address, device):
+    self.bEndpointAddress = address
+    self.bmAttributes = 0x03
+    self._device = device
+
+  def read(self, buf, timeout=None):
+    return self._device._in_read(buf, timeout)
+
+  def write(self, data, timeout=None):
+    return self._device._out_write(data)
+
+class _Interface(object):
+
+  def __init__(self, endpoints):
+    self._endpoints = endpoints
+
+  def endpoints(self):
+    return self._endpoints
+
+class _Configuration(object):
+
+  bConfigurationValue = 1
+
+  def __init__(self, interface):
+    self._interface = interface
+
+  def interfaces(self):
+    return (self._interface,)
+
+class _Context(object):
+  '''Stands in for the pyusb resource manager usb.util.dispose_resources
+  calls'''
+
+  def __init__(self):
+    self.disposed = 0
+
+  def dispose(self, device):
+    self.disposed += 1
+
+class USBDevice(object):
+  '''Emulated MSR605X that stands in for a usb.core.Device, including the
+  64 byte HID framing of messages in both directions'''
+
+  def __init__(self, emulator=None, bus=1, address=1):
+    import usb.core
+    self._usb_core = usb.core
+    self.emulator = emulator or Emulator()
+    self.idVendor, self.idProduct = _USB_IDS[0]
+    self.bus = bus
+    self.address = address
+    # Where it is plugged in, which unlike the address survives replugs
+    self.port_numbers = (address,)
+    self._config = _Configuration(_Interface([
+      _Endpoint(0x81, self), _Endpoint(0x01, self)
+    ]))
+    self._message = bytearray()
+    self._packets = []
+    self._ready = threading.Condition()
+    self._ctx = _Context()
+    self.plugged = True
+    self.emulator.output = self._send
+
+  def unplug(self):
+    '''Make every transfer fail as if the device was pulled out'''
+    with self._ready:
+      self.plugged = False
+      self._ready.notify_all()
+    # Losing power aborts whatever the reader was doing
+    self.emulator.feed(ESC + b'a')
+
+  def plug(self, address=None):
+    '''Bring the device back, at another address like a replugged one
+    unless address is given'''
+    with self._ready:
+      self.address = self.address + 1 if address is None else address
+      self._packets = []
+      self._message = bytearray()
+      self.plugged = True
+
+  def _check_plugged(self):
+    if not self.plugged:
+      raise self._usb_core.USBError('No such device', 19, 19)
+
+  def is_kernel_driver_active(self, interface):
+    return False
+
+  def detach_kernel_driver(self, interface):
+    pass
+
+  def get_active_configuration(self):
+    return self._config
+
+  def set_configuration(self, *args):
+    pass
+
+  def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0,
+                    data_or_wLength=None, timeout=None):
+    return self._out_write(data_or_wLength)
+
+  def _out_write(self, packet):
+    self._check_plugged()
+    packet = bytes(bytearray(packet))
+    header = packet[0]
+    if header & 0x80:
+      del self._message[:]
+    self._message += packet[1:1 + (header & 0x3f)]
+    if header & 0x40:
+      message = bytes(self._message)
+      del self._message[:]
+      self.emulator.feed(message)
+    return len(packet)
+
+  def _send(self, message):
+    packets = []
+    for idx in range(0, len(message), 63):
+      payload = message[idx:idx + 63]
+      header = len(payload)
+      if idx == 0:
+        header |= 0x80
+      if len(message) - idx <= 63:
+        header |= 0x40
+      packets.append(
+        bytes(bytearray([header])) + payload + bytes(63 - len(payload))
+      )
+    with self._ready:
+      self._packets.extend(packets)
+      self._ready.notify()
+
+  def _in_read(self, buf, timeout):
+    with self._ready:
+      deadline = None if not timeout else time.time() + timeout / 1000
+      while not self._packets:
+        self._check_plugged()
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+          raise self._usb_core.USBTimeoutError(
+            'Operation timed out', 110, 110
+          )
+        self._ready.wait(remaining)
+      packet = self._packets.pop(0)
+    buf[:len(packet)] = type(buf)('B', packet)
+    return len(packet)
+
+@contextlib.contextmanager
+def usb_emulators(count=1, swipe_latency=0.0):
+  '''Make usb.core.find return count emulated MSR605X devices
+
+  Yields the USBDevice list. Devices are on bus 1 at addresses 1 up.
+  Unplugged devices are not found.
+  '''
+  import usb.core
+  devices = [
+    USBDevice(Emulator(swipe_latency=swipe_latency), address=i + 1)
+    for i in range(count)
+  ]
+  real_find = usb.core.find
+
+  def find(find_all=False, **kwargs):
+    found = [
+      d for d in devices
+      if d.plugged and all(getattr(d, k, None) == v for k, v in kwargs.items())
+    ]
+    if find_all:
+      return iter(found)
+    return found[0] if found else None
+
+  usb.core.find = find
+  try:
+    yield devices
+  finally:
+    usb.core.find = real_find
+
+def main():
+
+  parser = argparse.ArgumentParser(
+    description='Serve emulated MSR605 readers on pseudo terminals'
+  )
+  parser.add_argument(
+    '-n', '--count',
+    metavar='N',
+    default=1,
+    type=int,
+    help='number of readers - defaults to 1'
+  )
+  parser.add_argument(
+    '-l', '--latency',
+    metavar='SECONDS',
+    default=0.0,
+    type=float,
+    help='time from command to emulated swipe - defaults to 0'
+  )
+  args = parser.parse_args()
+
+  emulators = [
+    PtyEmulator(Emulator(swipe_latency=args.latency))
+    for _ in range(args.count)
+  ]
+  for emu in emulators:
+    print(emu.port)
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
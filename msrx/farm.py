@@ -0,0 +1,207 @@
+# farm.py - Spread card jobs over many MSR605 readers
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Spread card jobs over many MSR605 readers
+
+    farm = Farm()                   # every reader discover() finds
+    futures = [farm.submit('write', tracks) for tracks in cards]
+    for f in futures:
+      device, _ = f.result()
+    farm.close()
+
+Each reader gets a worker thread that takes the next job from a shared
+queue whenever the reader is idle. A reader that fails max_failures
+jobs in a row with transport or protocol errors is dropped from
+rotation and the job it was working on goes back in the queue.
+"""
+
+from __future__ import division
+
+import threading
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+from concurrent.futures import Future
+
+from . import (
+  _clock, discover, Cancelled, DeviceError, MSRX, ProtocolError
+)
+
+class FarmError(Exception):
+  pass
+
+class _Job(object):
+
+  def __init__(self, op, arg):
+    self.op = op
+    self.arg = arg
+    self.future = Future()
+
+class _Unit(object):
+  '''Book keeping for one reader'''
+
+  def __init__(self, device):
+    self.device = device
+    self.active = True
+    self.jobs = 0
+    self.errors = 0
+    self.failures = 0
+    self.busy = 0.0
+    self.error = None
+
+class Farm(object):
+
+  def __init__(self, devices=None, retry=None, timeout=None,
+               max_failures=3, hico=False, reconnect=None):
+    '''Start a worker for each device
+
+    devices: device names for MSRX - defaults to discover()
+    retry: RetryPolicy used by every reader
+    timeout: seconds each job waits for its swipe
+    max_failures: consecutive failures before a reader is dropped
+    hico: put every reader in high coercivity mode
+    reconnect: seconds a lost reader gets to come back before its job
+               fails - see MSRX
+    '''
+    if devices is None:
+      devices = discover()
+    self.retry = retry
+    self.timeout = timeout
+    self.max_failures = max_failures
+    self.hico = hico
+    self.reconnect = reconnect
+    self._jobs = queue.Queue()
+    self._lock = threading.Lock()
+    self._started = _clock()
+    self._units = [_Unit(d) for d in devices]
+    self._threads = []
+    for unit in self._units:
+      t = threading.Thread(
+        target=self._work, args=(unit,), name='msrx-%s' % unit.device
+      )
+      t.daemon = True
+      t.start()
+      self._threads.append(t)
+
+  def submit(self, op, arg=None):
+    '''submit(op, arg) -> Future
+
+    Queue a job for the next idle reader. op is 'read', 'write' (arg is
+    the tracks to write) or 'erase' (arg is the tracks to erase). The
+    future's result is (device, value) where value is what the MSRX
+    method returned.
+    '''
+    if op not in ('read', 'write', 'erase'):
+      raise ValueError('unknown operation %r' % op)
+    job = _Job(op, arg)
+    with self._lock:
+      if not any(u.active for u in self._units):
+        raise FarmError('no readers left in rotation')
+      self._jobs.put(job)
+    return job.future
+
+  def close(self, wait=True):
+    '''Stop the workers once the queued jobs are done'''
+    for _ in self._threads:
+      self._jobs.put(None)
+    if wait:
+      for t in self._threads:
+        t.join()
+
+  def stats(self):
+    '''stats() -> [dict, ...]
+
+    Per reader: device, active, jobs, errors, busy (seconds spent on
+    jobs) and rate (jobs per minute since the farm started).
+    '''
+    elapsed = max(_clock() - self._started, 1e-9)
+    with self._lock:
+      return [{
+        'device': u.device,
+        'active': u.active,
+        'jobs': u.jobs,
+        'errors': u.errors,
+        'busy': u.busy,
+        'rate': u.jobs * 60 / elapsed,
+        'error': u.error
+      } for u in self._units]
+
+  def _drop(self, unit, error, job=None):
+    with self._lock:
+      unit.active = False
+      unit.error = error
+      if job is not None:
+        self._jobs.put(job)
+      if any(u.active for u in self._units):
+        return
+      # Nobody is left to take the queued jobs
+      while True:
+        try:
+          job = self._jobs.get_nowait()
+        except queue.Empty:
+          break
+        if job is not None and (
+          job.future.running() or job.future.set_running_or_notify_cancel()
+        ):
+          job.future.set_exception(FarmError('no readers left in rotation'))
+
+  def _work(self, unit):
+    try:
+      msrx = MSRX(unit.device, retry=self.retry, reconnect=self.reconnect)
+      msrx.reset()
+      if self.hico:
+        msrx.hico()
+    except (OSError, ProtocolError) as e:
+      self._drop(unit, e)
+      return
+
+    while True:
+      job = self._jobs.get()
+      if job is None:
+        break
+      if not job.future.running() \
+          and not job.future.set_running_or_notify_cancel():
+        continue
+      args = () if job.arg is None else (job.arg,)
+      start = _clock()
+      try:
+        value = getattr(msrx, job.op)(*args, timeout=self.timeout)
+      except (OSError, ProtocolError) as e:
+        with self._lock:
+          unit.errors += 1
+          unit.failures += 1
+          unit.busy += _clock() - start
+        if unit.failures >= self.max_failures:
+          self._drop(unit, e, job)
+          return
+        job.future.set_exception(e)
+      except (DeviceError, Cancelled) as e:
+        with self._lock:
+          unit.errors += 1
+          unit.busy += _clock() - start
+        job.future.set_exception(e)
+      else:
+        with self._lock:
+          unit.jobs += 1
+          unit.failures = 0
+          unit.busy += _clock() - start
+        job.future.set_result((unit.device, value))
+
+    if self.hico:
+      msrx.loco()
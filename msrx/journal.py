@@ -0,0 +1,65 @@
+# journal.py - Resume journal for batch card jobs
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Resume journal for batch card jobs
+
+The journal is a text file with one tab separated line per attempt:
+time, line number of the record in the batch, digest of the record and
+the result ('ok', the DeviceError code or 'mismatch' when a --verify
+write didn't read back right). A record counts as done when
+its line number and digest have an 'ok' entry, so editing a record in
+the batch makes it run again.
+"""
+
+import hashlib
+import os
+import time
+
+class Journal(object):
+
+  def __init__(self, path):
+    '''Load the journal at path (if any) and open it for appending'''
+    self.path = path
+    self._done = set()
+    if os.path.exists(path):
+      with open(path) as f:
+        for line in f:
+          fields = line.rstrip('\n').split('\t')
+          # A crash can leave a truncated last line behind
+          if len(fields) == 4 and fields[3] == 'ok':
+            self._done.add((fields[1], fields[2]))
+    self._file = open(path, 'a')
+
+  @staticmethod
+  def digest(record):
+    return hashlib.sha1(record.encode('utf-8')).hexdigest()[:16]
+
+  def is_done(self, lineno, record):
+    '''Whether record, found at lineno in the batch, was done before'''
+    return (str(lineno), self.digest(record)) in self._done
+
+  def record(self, lineno, record, result):
+    '''Append the result for record and make sure it hits the disk'''
+    self._file.write('%.3f\t%d\t%s\t%s\n' % (
+      time.time(), lineno, self.digest(record), result
+    ))
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    if result == 'ok':
+      self._done.add((str(lineno), self.digest(record)))
+
+  def close(self):
+    self._file.close()
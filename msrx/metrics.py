@@ -0,0 +1,196 @@
+# metrics.py - Latency histograms and error counters for MSR605 readers
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Latency histograms and error counters for MSR605 readers
+
+Every MSRX records into its metrics attribute:
+
+    send      writing a command to the device
+    swipe     from a command to the start of the response - the time
+              spent waiting for the operator (whole write and erase
+              operations count here as their only response is the
+              status)
+    transfer  from the start to the end of the track data
+    status    from the end of the track data to the status
+    usb_out   one 64 byte packet sent to an MSR605X
+    usb_in    one 64 byte packet received from an MSR605X after the
+              first of its message, which waits for the response
+    reconnect from losing the device to having it back
+
+plus counters of device errors by code, protocol errors and timeouts.
+
+    msr = msrx.MSRX('usb')
+    ...
+    print(msr.metrics.snapshot())
+    msr.metrics.write_textfile('/var/lib/node_exporter/msrx.prom')
+"""
+
+from __future__ import division
+
+import os
+import threading
+
+PHASES = (
+  'send', 'swipe', 'transfer', 'status', 'usb_out', 'usb_in', 'reconnect'
+)
+
+# Upper bounds in seconds, from USB packets up to slow operators
+BUCKETS = (
+  0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+  1.0, 2.5, 5.0, 10.0, 30.0, float('inf')
+)
+
+class Histogram(object):
+
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[i] += 1
+        break
+    self.sum += value
+    self.count += 1
+
+  def quantile(self, q):
+    '''Upper bound of the bucket holding the q quantile, None if empty'''
+    if not self.count:
+      return None
+    rank, acc = q * self.count, 0
+    for bound, count in zip(self.buckets, self.counts):
+      acc += count
+      if acc >= rank:
+        return bound
+    return self.buckets[-1]
+
+class Metrics(object):
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.histograms = dict((p, Histogram()) for p in PHASES)
+      self.device_errors = {}
+      self.protocol_errors = 0
+      self.timeouts = 0
+
+  def observe(self, phase, seconds):
+    with self._lock:
+      self.histograms[phase].observe(seconds)
+
+  def device_error(self, code):
+    with self._lock:
+      self.device_errors[code] = self.device_errors.get(code, 0) + 1
+
+  def protocol_error(self):
+    with self._lock:
+      self.protocol_errors += 1
+
+  def timeout(self):
+    with self._lock:
+      self.timeouts += 1
+
+  def snapshot(self):
+    '''snapshot() -> dict
+
+    phases: per phase count, sum (seconds), mean, p50, p90 and p99 (the
+    upper bound of the bucket holding each quantile)
+    device_errors: count by DeviceError code
+    protocol_errors, timeouts: counts
+    '''
+    with self._lock:
+      return {
+        'phases': dict((p, {
+          'count': h.count,
+          'sum': h.sum,
+          'mean': h.sum / h.count if h.count else None,
+          'p50': h.quantile(0.5),
+          'p90': h.quantile(0.9),
+          'p99': h.quantile(0.99)
+        }) for p, h in self.histograms.items()),
+        'device_errors': dict(self.device_errors),
+        'protocol_errors': self.protocol_errors,
+        'timeouts': self.timeouts
+      }
+
+  def prometheus(self, labels=None, prefix='msrx'):
+    '''Metrics in the Prometheus text exposition format
+
+    labels: dict of extra labels for every sample, e.g. {'device': ...}
+    '''
+    def fmt(extra=()):
+      pairs = sorted((labels or {}).items()) + list(extra)
+      if not pairs:
+        return ''
+      return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs
+      )
+
+    lines = []
+    with self._lock:
+      name = prefix + '_phase_seconds'
+      lines += [
+        '# HELP %s Latency of MSR605 command phases' % name,
+        '# TYPE %s histogram' % name
+      ]
+      for phase in PHASES:
+        h = self.histograms[phase]
+        acc = 0
+        for bound, count in zip(h.buckets, h.counts):
+          acc += count
+          le = '+Inf' if bound == float('inf') else repr(bound)
+          lines.append('%s_bucket%s %d' % (
+            name, fmt([('phase', phase), ('le', le)]), acc
+          ))
+        lines.append('%s_sum%s %r' % (name, fmt([('phase', phase)]), h.sum))
+        lines.append('%s_count%s %d' % (name, fmt([('phase', phase)]),
+                                         h.count))
+
+      name = prefix + '_device_errors_total'
+      lines += [
+        '# HELP %s Operations that failed with a device error' % name,
+        '# TYPE %s counter' % name
+      ]
+      for code, count in sorted(self.device_errors.items()):
+        lines.append('%s%s %d' % (name, fmt([('code', code)]), count))
+
+      for name, help, value in (
+        ('protocol_errors_total', 'Malformed or unexpected responses',
+         self.protocol_errors),
+        ('timeouts_total', 'Operations that timed out', self.timeouts)
+      ):
+        name = prefix + '_' + name
+        lines += [
+          '# HELP %s %s' % (name, help),
+          '# TYPE %s counter' % name,
+          '%s%s %d' % (name, fmt(), value)
+        ]
+    return '\n'.join(lines) + '\n'
+
+  def write_textfile(self, path, labels=None):
+    '''Write prometheus() to path for the node_exporter textfile
+    collector - the file is replaced atomically'''
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+      f.write(self.prometheus(labels))
+    os.rename(tmp, path)
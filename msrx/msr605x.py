@@ -60,13 +60,24 @@ From README.md:
     - Windows VM with MSR605X gui
 """
 
+import collections
+import errno
+import time
+
 import usb
 import usb.core
+import usb.util
 
 SEQUENCE_START_BIT = 0b10000000
 SEQUENCE_END_BIT = 0b01000000
 SEQUENCE_LENGTH_BITS = 0b00111111
 ESC = b"\x1b"
+PACKET_SIZE = 64
+PAYLOAD_SIZE = PACKET_SIZE - 1
+
+# (bus, address) of the devices this process has already configured -
+# opening one again skips the configuration check
+_set_up = set()
 
 class MSR605X:
     """ Represents a MSR605X device
@@ -82,22 +93,59 @@ class MSR605X:
             kwargs["idVendor"] = 0x0801
             kwargs["idProduct"] = 0x0003
         self.dev = usb.core.find(**kwargs)
+        if self.dev is None:
+            raise usb.core.USBError("MSR605X not found", errno=errno.ENODEV)
         self.hid_endpoint = None
-        self.buffer = b''
+        self.out_endpoint = None
+        # (direction, bytes, seconds) of the most recent USB transfers -
+        # received packets only after the first of their message
+        self.transfer_times = collections.deque(maxlen=256)
+        # msrx.metrics.Metrics to record packet latencies into, if any
+        self.metrics = None
+        self._out_packet = bytearray(PACKET_SIZE)
+        self._in_packet = usb.util.create_buffer(PACKET_SIZE)
+        self.buffer = bytearray()
+        self._buffer_pos = 0
+        self._partial = bytearray()
+        self._partial_started = False
+        # Seconds read() waits for data, None to wait forever (as pyserial)
+        self.timeout = None
     def connect(self):
         """ Establish a connection to the MSR605X """
         dev = self.dev
+        key = (dev.bus, dev.address)
+        # A USB reset keeps the address but lets usbhid bind again, so this
+        # one is always checked
         if dev.is_kernel_driver_active(0):
             dev.detach_kernel_driver(0)
+        if key not in _set_up:
+            # An unconfigured device raises rather than returning None, and
+            # a configured one is left alone as setting the configuration
+            # again resets it
+            try:
+                config = dev.get_active_configuration()
+            except usb.core.USBError:
+                config = None
+            if config is None or config.bConfigurationValue != 1:
+                dev.set_configuration()
+            _set_up.add(key)
         config = dev.get_active_configuration()
-        if config is None or config.bConfigurationValue != 1:
-            dev.set_configuration()
-            config = dev.get_active_configuration()
         interface = config.interfaces()[0]
-        self.hid_endpoint = interface.endpoints()[0]
-    # def disconnect(self):
-        # dev = self.dev
-        # dev.detach_kernel_driver(0)
+        endpoints = interface.endpoints()
+        self.hid_endpoint = endpoints[0]
+        self.out_endpoint = None
+        # Prefer the interrupt endpoints, writes fall back to SET_REPORT
+        # control transfers when there is no interrupt OUT endpoint
+        for endpoint in endpoints:
+            if usb.util.endpoint_type(endpoint.bmAttributes) != usb.util.ENDPOINT_TYPE_INTR:
+                continue
+            if usb.util.endpoint_direction(endpoint.bEndpointAddress) == usb.util.ENDPOINT_IN:
+                self.hid_endpoint = endpoint
+            elif self.out_endpoint is None:
+                self.out_endpoint = endpoint
+    def close(self):
+        """ Release the interface and everything pyusb holds for the device """
+        usb.util.dispose_resources(self.dev)
     def _make_header(self, start_of_sequence: bool, end_of_sequence: bool, length: int):
         if length < 0 or length > 63:
             raise ValueError("Length must be a non-negative number no more than 63")
@@ -108,41 +156,95 @@ class MSR605X:
             header |= SEQUENCE_END_BIT
         return bytes([header])
     def _encapsulate_message(self, message):
+        """ Split message into packets
+
+        The same preallocated packet buffer is reused for every packet, so
+        each packet must be sent before asking for the next one.
+        """
+        packet = self._out_packet
+        view = memoryview(packet)
+        size = len(message)
         idx = 0
-        while idx < len(message):
-            payload = message[idx:idx+63]
-            header = self._make_header(idx == 0, len(message) - idx < 64, len(payload))
-            padding = b"\0" * (63 - len(payload))
-            yield header + payload + padding
-            idx += 63
+        while idx < size:
+            length = min(size - idx, PAYLOAD_SIZE)
+            header = length
+            if idx == 0:
+                header |= SEQUENCE_START_BIT
+            if size - idx <= PAYLOAD_SIZE:
+                header |= SEQUENCE_END_BIT
+            packet[0] = header
+            view[1:1 + length] = message[idx:idx + length]
+            view[1 + length:] = bytes(PAYLOAD_SIZE - length)
+            yield packet
+            idx += PAYLOAD_SIZE
     def _send_packet(self, packet):
-        self.dev.ctrl_transfer(0x21, 9, wValue=0x0300, wIndex=0, data_or_wLength=packet)
+        start = time.perf_counter()
+        if self.out_endpoint is not None:
+            self.out_endpoint.write(packet)
+        else:
+            self.dev.ctrl_transfer(0x21, 9, wValue=0x0300, wIndex=0, data_or_wLength=packet)
+        elapsed = time.perf_counter() - start
+        self.transfer_times.append(("out", len(packet), elapsed))
+        if self.metrics is not None:
+            self.metrics.observe("usb_out", elapsed)
     def _recv_packet(self, **kwargs):
+        """ Receive one packet into the preallocated packet buffer
+
+        The returned view is only valid until the next call. Only packets
+        that continue a message are timed, as the wait for the first one
+        is the wait for the response (e.g. for a swipe), not USB latency.
+        """
+        timed = self._partial_started
+        start = time.perf_counter()
         try:
-            return bytes(self.hid_endpoint.read(64, **kwargs))
+            count = self.hid_endpoint.read(self._in_packet, **kwargs)
         except usb.core.USBError as error:
             if error.errno == 110:
                 return None
             raise error
+        if timed:
+            elapsed = time.perf_counter() - start
+            self.transfer_times.append(("in", count, elapsed))
+            if self.metrics is not None:
+                self.metrics.observe("usb_in", elapsed)
+        return memoryview(self._in_packet)[:count]
     def send_message(self, message):
         """ Send a message to the MSR605X """
         for packet in self._encapsulate_message(message):
             self._send_packet(packet)
-    def recv_message(self, timeout=0):
-        """ Receive message from the MSR605X """
-        message = b""
+    def _recv_message_into(self, out, timeout=0):
+        """ Reassemble one message from the MSR605X and append it to out
+
+        Packets that arrive before the start of a sequence are dropped, and a
+        new start bit discards whatever was collected of an unfinished
+        message. Returns False on timeout, keeping any partially received
+        message to be completed by the next call.
+        """
+        partial = self._partial
         while True:
             packet = self._recv_packet(timeout=timeout)
-            if packet is None and not message:
-                return None
-            payload_length = packet[0] & SEQUENCE_LENGTH_BITS
-            payload = packet[1:1+payload_length]
-            message = message + payload
-            # note: we don't actually check the sequence start bit currently, we probably should to
-            # check this in case we somehow start reading in the middle of a message
-            if packet[0] & SEQUENCE_END_BIT:
-                break
-        return payload
+            if packet is None:
+                return False
+            if not packet:
+                continue
+            header = packet[0]
+            if header & SEQUENCE_START_BIT:
+                del partial[:]
+                self._partial_started = True
+            elif not self._partial_started:
+                continue
+            partial += packet[1:1 + (header & SEQUENCE_LENGTH_BITS)]
+            if header & SEQUENCE_END_BIT:
+                out += partial
+                del partial[:]
+                self._partial_started = False
+                return True
+    def recv_message(self, timeout=0):
+        """ Receive message from the MSR605X """
+        message = bytearray()
+        if not self._recv_message_into(message, timeout=timeout):
+            return None
+        return bytes(message)
     def reset(self):
         """ Sends reset message to the MSR605X """
         self.send_message(ESC + b"a")
@@ -153,14 +255,33 @@ class MSR605X:
         assert ret[0:1] == ESC
         return ret[1:]
     def flush(self):
-        self.buffer = b''
+        del self.buffer[:]
+        self._buffer_pos = 0
+    def reset_input_buffer(self):
+        """ Discard received data, including packets still in flight """
+        while self._recv_packet(timeout=10) is not None:
+            pass
+        del self._partial[:]
+        self._partial_started = False
+        self.flush()
     def write(self, d):
         self.send_message(d)
+    def _fill(self, count):
+        """ Receive messages until count bytes are buffered or a timeout """
+        if self._buffer_pos and self._buffer_pos * 2 >= len(self.buffer):
+            del self.buffer[:self._buffer_pos]
+            self._buffer_pos = 0
+        timeout = 0 if self.timeout is None else max(1, int(self.timeout * 1000))
+        while len(self.buffer) - self._buffer_pos < count:
+            if not self._recv_message_into(self.buffer, timeout=timeout):
+                break
+        return min(count, len(self.buffer) - self._buffer_pos)
+    @property
+    def in_waiting(self):
+        """ Number of received bytes that have not been read yet """
+        return len(self.buffer) - self._buffer_pos
     def read(self, count):
-        buf_len = len(self.buffer)
-        if count > buf_len:
-            new_data = self.recv_message()
-            self.buffer = self.buffer + new_data
-        ret = self.buffer[:count]
-        self.buffer = self.buffer[count:]
-        return ret
\ No newline at end of file
+        count = self._fill(count)
+        pos = self._buffer_pos
+        self._buffer_pos = pos + count
+        return bytes(memoryview(self.buffer)[pos:pos + count])
@@ -0,0 +1,200 @@
+# trace.py - Record and replay the traffic between MSRX and a reader
+# Copyright (C) 2020  Josh Watts <josh+github@sroz.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Record and replay the traffic between MSRX and a reader
+
+    msr = MSRX('/dev/ttyUSB0', trace='session.trace')   # record
+    msr = MSRX('replay:session.trace')                  # recorded speed
+    msr = MSRX('replay-fast:session.trace')             # no delays
+
+A trace file starts with MAGIC followed by one record per transfer: a
+byte for the kind (WRITE, READ or DISCARD), the microseconds since the
+trace started as an unsigned 64 bit and the data length as an unsigned
+32 bit integer, all little endian, then the data. READ records hold
+whatever one read from the transport returned - a chunk of the serial
+stream or a whole MSR605X message - and DISCARD records what was
+dropped by reset_input_buffer.
+
+On replay, writes are checked against the recorded ones and each READ
+record becomes readable once the writes before it were made (and, at
+recorded speed, as long after the last of them as it was recorded).
+"""
+
+import struct
+import threading
+import time
+
+from . import _clock, ProtocolError
+
+MAGIC = b'MSRXTRC\x01'
+
+WRITE, READ, DISCARD = 0, 1, 2
+
+_HEADER = struct.Struct('<BQI')
+
+class TraceMismatch(ProtocolError):
+  '''The host wrote something else than the recorded host did'''
+
+def load(path):
+  '''load(path) -> [(kind, seconds, data), ...]'''
+  with open(path, 'rb') as f:
+    data = f.read()
+  if data[:len(MAGIC)] != MAGIC:
+    raise ValueError('%s is not an msrx trace' % path)
+  records, pos = [], len(MAGIC)
+  while pos + _HEADER.size <= len(data):
+    kind, usecs, size = _HEADER.unpack_from(data, pos)
+    pos += _HEADER.size
+    # A crash can leave a truncated last record behind
+    if pos + size > len(data):
+      break
+    records.append((kind, usecs / 1e6, data[pos:pos + size]))
+    pos += size
+  return records
+
+class Recorder(object):
+  '''Transport wrapper that logs everything passing through it'''
+
+  def __init__(self, dev, path):
+    self._dev = dev
+    self._file = open(path, 'wb')
+    self._file.write(MAGIC)
+    self._lock = threading.Lock()
+    self._start = _clock()
+
+  def _record(self, kind, data):
+    with self._lock:
+      self._file.write(_HEADER.pack(
+        kind, int((_clock() - self._start) * 1e6), len(data)
+      ))
+      self._file.write(data)
+      # Keep what led up to a crash or a hung reader
+      self._file.flush()
+
+  def __getattr__(self, name):
+    return getattr(self._dev, name)
+
+  @property
+  def timeout(self):
+    return self._dev.timeout
+
+  @timeout.setter
+  def timeout(self, value):
+    self._dev.timeout = value
+
+  def write(self, d):
+    self._record(WRITE, bytes(d))
+    return self._dev.write(d)
+
+  def read(self, count=1):
+    data = self._dev.read(count)
+    if data:
+      self._record(READ, bytes(data))
+    return data
+
+  def reset_input_buffer(self):
+    waiting = self._dev.in_waiting
+    self._record(DISCARD, bytes(self._dev.read(waiting)) if waiting else b'')
+    self._dev.reset_input_buffer()
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+    if hasattr(self._dev, 'close'):
+      self._dev.close()
+
+class Replay(object):
+  '''Transport that plays a trace back to MSRX'''
+
+  def __init__(self, path, realtime=True, timeout=None, strict=True):
+    '''realtime: keep the recorded delays, otherwise as fast as possible
+    timeout: seconds read() waits for data, None to wait forever
+    strict: raise TraceMismatch when a write differs from the trace
+    '''
+    self.records = load(path)
+    self.realtime = realtime
+    self.timeout = timeout
+    self.strict = strict
+    # Next record to write and to read, and when the write the next read
+    # depends on was replayed
+    self._wpos = 0
+    self._rpos = 0
+    self._chunk = b''
+    self._anchor = (_clock(), 0.0)
+
+  def _next(self, pos, kinds):
+    while pos < len(self.records) and self.records[pos][0] not in kinds:
+      pos += 1
+    return pos
+
+  def _due(self):
+    '''Seconds until the next READ record is readable, None if it waits
+    for a write or there is none'''
+    pos = self._next(self._rpos, (READ, DISCARD))
+    if pos >= len(self.records) or self.records[pos][0] == DISCARD:
+      return None
+    if self._next(self._wpos, (WRITE,)) < pos:
+      return None
+    self._rpos = pos
+    if not self.realtime:
+      return 0
+    host, recorded = self._anchor
+    return max(0, host + self.records[pos][1] - recorded - _clock())
+
+  def write(self, d):
+    pos = self._next(self._wpos, (WRITE,))
+    if pos >= len(self.records):
+      if self.strict:
+        raise TraceMismatch('write past the end of the trace')
+      return len(d)
+    if self.strict and bytes(d) != self.records[pos][2]:
+      raise TraceMismatch('write %d differs from the trace' % pos)
+    self._wpos = pos + 1
+    self._anchor = (_clock(), self.records[pos][1])
+    return len(d)
+
+  def flush(self):
+    pass
+
+  @property
+  def in_waiting(self):
+    if not self._chunk and self._due() == 0:
+      self._chunk = self.records[self._rpos][2]
+      self._rpos += 1
+    return len(self._chunk)
+
+  def read(self, count=1):
+    deadline = None if self.timeout is None else _clock() + self.timeout
+    while not self.in_waiting:
+      due = self._due()
+      wait = 0.01 if due is None else due
+      if deadline is not None:
+        wait = min(wait, deadline - _clock())
+        if wait <= 0:
+          return b''
+      time.sleep(wait)
+    data, self._chunk = self._chunk[:count], self._chunk[count:]
+    return data
+
+  def reset_input_buffer(self):
+    self._chunk = b''
+    pos = self._next(self._rpos, (DISCARD,))
+    if pos < len(self.records) and self._next(self._wpos, (WRITE,)) > pos:
+      self._rpos = pos + 1
+      self._anchor = (_clock(), self.records[pos][1])
+
+  def close(self):
+    pass
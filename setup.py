@@ -28,7 +28,7 @@ setup(
   name='msrx',
   version=msrx.__version__,
   packages=['msrx'],
-  scripts=['scripts/msrx'],
+  scripts=['scripts/msrx', 'scripts/msrxd'],
   install_requires=['PySerial'],
 
   author=msrx.__author__,